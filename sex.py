@@ -1,15 +1,28 @@
 import json
 import os  # <-- уже есть
 import asyncio
+import fcntl
+import hmac
+import httpx
 import random
 import logging
+import signal
+import socket
+import sqlite3
 import time
-from datetime import datetime
-from typing import Dict, List, Optional, Set
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, ConversationHandler
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Set
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, User
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, ConversationHandler
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 import telegram.ext.filters as filters
+import tornado.web
+from tornado.httpserver import HTTPServer
 
 # Настройка логов
 logging.basicConfig(
@@ -27,13 +40,111 @@ if not API_TOKEN:
     print("Установите переменную окружения BOT_TOKEN на хостинге")
     exit(1)
 
+# Режим вебхука: если задан WEBHOOK_URL, Telegram сам присылает обновления
+# на WEBHOOK_URL + WEBHOOK_PATH, иначе бот работает через polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+# Telegram присылает секрет в заголовке каждого запроса. Обязателен в режиме
+# вебхука и должен быть одинаковым у всех процессов за балансировщиком:
+# set_webhook вызывает каждый процесс, и принимается секрет последнего
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# Другой адрес Bot API, например локальный сервер: http://localhost:8081/bot
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "")
+
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    print("❌ ОШИБКА: для режима вебхука нужна переменная окружения WEBHOOK_SECRET!")
+    print("Задайте одинаковое значение (A-Z, a-z, 0-9, _ и -) для всех процессов бота")
+    exit(1)
+
 ADMIN_IDS = [6997318168 ]
 MASTER_ID = 6997318168
 
 CHANNELS_FILE = 'channels.json'
+# Каналы для подписки, пока channels.json еще не создан
+DEFAULT_CHANNELS = {
+    "1": {"name": "Канал №1", "link": "https://t.me/+k1eBaFb3N8FkYmM6"},
+    "2": {"name": "Канал №2", "link": "https://t.me/+nQNnRAQuXkxmODky"}
+}
 SUBMISSIONS_FILE = 'submissions.json'
 BROADCAST_CHANNELS_FILE = 'broadcast_channels.json'
 USERS_FILE = 'users.json'
+# Сколько предыдущих версий JSON-файла хранить (file.json.bak1 ... bakN)
+JSON_BACKUP_COUNT = 3
+DB_FILE = 'bot.db'
+
+# Отложенная запись пользователей: сброс по таймеру или при накоплении
+USER_FLUSH_INTERVAL = 5
+USER_FLUSH_MAX_PENDING = 500
+
+# Сколько пользователей держать в памяти в индексе заявок и сколько секунд
+# верить кэшу (заявку мог записать другой процесс бота)
+SUBMISSIONS_CACHE_SIZE = 10000
+SUBMISSIONS_CACHE_TTL = 10
+
+# Сколько обработчиков обновлений выполняется одновременно. Обновления
+# одного пользователя все равно идут по очереди, лишние ждут в его очереди
+# (не больше USER_UPDATE_QUEUE_LIMIT, остальные отбрасываются)
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "32"))
+USER_UPDATE_QUEUE_LIMIT = 50
+
+# Проверка прав бота в каналах рассылки
+PERMISSION_CHECK_CONCURRENCY = 10
+PERMISSION_CHECK_RETRIES = 3
+PERMISSION_PROGRESS_INTERVAL = 2
+
+# Статус доступа к каналу считается свежим ACCESS_STATUS_TTL секунд,
+# устаревшие статусы перепроверяются фоновой задачей
+ACCESS_STATUS_TTL = 600
+ACCESS_REFRESH_INTERVAL = 60
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота, ~1 в секунду в личный
+# чат и ~20 в минуту в группу или канал. Берем с небольшим запасом.
+GLOBAL_SEND_RATE = 25
+PRIVATE_CHAT_SEND_INTERVAL = 1.0
+GROUP_CHAT_SEND_INTERVAL = 3.0
+SEND_RETRIES = 3
+SEND_RETRY_BACKOFF = 0.5
+
+# Движок рассылок: сколько запросов одновременно в полете
+DELIVERY_CONCURRENCY = 20
+# Сколько получателей сохраненной рассылки брать из базы за раз
+DELIVERY_CLAIM_BATCH = 50
+# Как часто (в секундах) обновлять сообщение с прогрессом рассылки
+DELIVERY_PROGRESS_INTERVAL = 3
+# Сколько первых ошибок рассылки держать в памяти для отчета
+DELIVERY_FAILURES_KEPT = 10
+# Сколько секунд при остановке бота ждать, пока рассылки доведут начатые отправки
+DELIVERY_STOP_TIMEOUT = 15
+
+# Несколько процессов бота с общей базой: фоновую работу (рассылку,
+# перепроверку каналов) выполняет тот, кто держит аренду в таблице leases.
+# Владелец продлевает аренду, при его падении она истекает через LEASE_TTL.
+# Обновления Telegram: через polling их получает только один процесс
+# (аренда POLLING_LEASE, иначе Telegram отвечает 409 Conflict), через вебхук -
+# все, но состояние диалогов (ConversationHandler, user_data) живет в памяти
+# процесса, поэтому балансировщик должен слать обновления одного пользователя
+# всегда в один процесс. Подробнее в README.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+LEASE_TTL = 30
+POLLING_LEASE = 'polling'
+# Как часто владелец рассылки продлевает аренду, сохраняет прогресс
+# и забирает команды паузы/отмены, пришедшие через другие процессы
+DELIVERY_HEARTBEAT_INTERVAL = 2
+# Статистику пользователей пишут все процессы, поэтому она перечитывается
+USER_STATS_RELOAD_INTERVAL = 300
+# Как часто (в секундах) писать в лог счетчики попаданий кэша
+CACHE_STATS_LOG_INTERVAL = 600
+
+# Сегменты аудитории для рассылки пользователям:
+# ключ -> (название, колонка с датой, за сколько дней)
+AUDIENCE_SEGMENTS = {
+    'all': ("👥 Все пользователи", None, None),
+    'week': ("📈 Активные за неделю", 'last_seen', 7),
+    'month': ("📈 Активные за месяц", 'last_seen', 30),
+    'new': ("🆕 Новые за неделю", 'joined_date', 7),
+}
 
 # Остальной код без изменений...
 
@@ -50,285 +161,1095 @@ def is_master(user_id: int) -> bool:
     return user_id == MASTER_ID
 
 # ===== КЭШИРОВАНИЕ =====
-class Cache:
+def _file_signature(path: str) -> Optional[tuple]:
+    """Отпечаток файла: меняется при любой перезаписи, в том числе через rename"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+class CacheEntry:
+    """Данные одного раздела кэша и read-only представление над ними"""
+    __slots__ = ('data', 'view', 'version', 'signature', 'checked',
+                 'hits', 'misses', 'reloads')
+    
     def __init__(self):
-        self._users = None
-        self._users_time = None
-        self._channels = None
-        self._channels_time = None
-        self._broadcast = None
-        self._broadcast_time = None
-        self._submissions = None
-        self._submissions_time = None
-        self.ttl = 60
-    
-    def _is_valid(self, cache_time):
-        if cache_time is None:
-            return False
-        return (datetime.now() - cache_time).seconds < self.ttl
+        self.data = None
+        self.view = None
+        self.version = 0
+        self.signature = None
+        self.checked = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+class Cache:
+    """Кэш без копирования: чтение отдает MappingProxyType над данными.
+    Данные раздела не меняются на месте: после записи в файл в кэш
+    кладется новый словарь через set, при ошибке раздел сбрасывается.
     
-    # Пользователи
-    def get_users(self):
-        if self._users and self._is_valid(self._users_time):
-            return self._users.copy()
-        return None
+    Раздел живет, пока его файл не изменится (проверка по inode,
+    mtime и размеру не чаще раза в stat_interval секунд).
+    Пустые данные тоже считаются попаданием."""
+    SOURCES = {'channels': CHANNELS_FILE, 'broadcast': BROADCAST_CHANNELS_FILE}
     
-    def set_users(self, data):
-        self._users = data.copy() if data else {}
-        self._users_time = datetime.now()
+    def __init__(self):
+        self._entries = {name: CacheEntry() for name in self.SOURCES}
+        self.stat_interval = 1.0
+    
+    def _is_fresh(self, name: str, entry: CacheEntry) -> bool:
+        now = time.monotonic()
+        if now - entry.checked < self.stat_interval:
+            return True
+        entry.checked = now
+        return _file_signature(self.SOURCES[name]) == entry.signature
+    
+    def get(self, name: str) -> Optional[Mapping]:
+        entry = self._entries[name]
+        if entry.data is None:
+            entry.misses += 1
+            return None
+        
+        if not self._is_fresh(name, entry):
+            entry.misses += 1
+            entry.reloads += 1
+            self.invalidate(name)
+            return None
+        
+        entry.hits += 1
+        return entry.view
+    
+    def set(self, name: str, data: Dict, signature: Optional[tuple] = None) -> Mapping:
+        """Кэш забирает словарь себе: вызывающий больше не должен его менять.
+        signature - отпечаток файла, из которого прочитаны данные."""
+        entry = self._entries[name]
+        entry.data = data
+        entry.view = MappingProxyType(entry.data)
+        entry.signature = signature
+        entry.checked = time.monotonic()
+        entry.version += 1
+        return entry.view
+    
+    def invalidate(self, name: str):
+        entry = self._entries[name]
+        entry.data = None
+        entry.view = None
+        entry.signature = None
+        entry.version += 1
+    
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            name: {'hits': entry.hits, 'misses': entry.misses,
+                   'reloads': entry.reloads, 'version': entry.version}
+            for name, entry in self._entries.items()
+        }
+
+cache = Cache()
+
+async def log_cache_stats_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически пишет в лог попадания, промахи и перечитывания кэша"""
+    parts = [
+        f"{name} hits={counters['hits']} misses={counters['misses']} reloads={counters['reloads']}"
+        for name, counters in cache.stats().items()
+    ]
+    logger.info(f"Cache stats: {'; '.join(parts)}")
+
+# ===== ХРАНИЛИЩЕ (SQLite) =====
+_db: Optional[sqlite3.Connection] = None
+
+def _add_column(db: sqlite3.Connection, table: str, column: str, definition: str):
+    """Добавляет колонку в таблицу, созданную до ее появления"""
+    columns = {row['name'] for row in db.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        logger.info(f"Added column {table}.{column}")
+
+def get_db() -> sqlite3.Connection:
+    """Подключение к базе (создается при первом обращении)"""
+    global _db
+    if _db is None:
+        # Базу могут одновременно писать несколько процессов бота
+        db = sqlite3.connect(DB_FILE, timeout=30, check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id     INTEGER PRIMARY KEY,
+                username    TEXT NOT NULL DEFAULT '',
+                first_name  TEXT NOT NULL DEFAULT '',
+                last_name   TEXT NOT NULL DEFAULT '',
+                last_seen   TEXT,
+                joined_date TEXT,
+                active      INTEGER NOT NULL DEFAULT 1
+            );
+            CREATE TABLE IF NOT EXISTS submissions (
+                user_id      INTEGER NOT NULL,
+                channel_id   TEXT NOT NULL,
+                submitted_at TEXT,
+                PRIMARY KEY (user_id, channel_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS delivery_jobs (
+                job_id              INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind                TEXT NOT NULL,
+                message             TEXT NOT NULL,
+                status              TEXT NOT NULL,
+                total               INTEGER NOT NULL DEFAULT 0,
+                progress_chat_id    INTEGER,
+                progress_message_id INTEGER,
+                created_at          TEXT,
+                finished_at         TEXT,
+                sent                INTEGER NOT NULL DEFAULT 0,
+                failed              INTEGER NOT NULL DEFAULT 0,
+                rate                REAL NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS delivery_recipients (
+                job_id  INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                status  INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (job_id, chat_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS leases (
+                name       TEXT PRIMARY KEY,
+                owner      TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+        """)
+        _add_column(db, 'users', 'active', "INTEGER NOT NULL DEFAULT 1")
+        _add_column(db, 'delivery_jobs', 'sent', "INTEGER NOT NULL DEFAULT 0")
+        _add_column(db, 'delivery_jobs', 'failed', "INTEGER NOT NULL DEFAULT 0")
+        _add_column(db, 'delivery_jobs', 'rate', "REAL NOT NULL DEFAULT 0")
+        # Для сегментов рассылки: выборка по дате без просмотра всей таблицы
+        db.executescript("""
+            CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen);
+            CREATE INDEX IF NOT EXISTS idx_users_joined_date ON users (joined_date);
+        """)
+        migrate_users_json(db)
+        migrate_submissions_json(db)
+        _db = db
+    return _db
+
+def migrate_users_json(db: sqlite3.Connection) -> int:
+    """Одноразовый перенос users.json в базу"""
+    if not os.path.exists(USERS_FILE):
+        return 0
     
-    def invalidate_users(self):
-        self._users = None
-        self._users_time = None
+    try:
+        with open(USERS_FILE, 'r', encoding='utf-8') as f:
+            users = json.load(f)
+    except Exception as e:
+        logger.error(f"Error reading {USERS_FILE} for migration: {e}")
+        return 0
     
-    # Каналы подписки
-    def get_channels(self):
-        if self._channels and self._is_valid(self._channels_time):
-            return self._channels.copy()
-        return None
+    rows = []
+    for user_id_str, user_data in users.items():
+        try:
+            user_id = int(user_id_str)
+        except ValueError:
+            logger.warning(f"Skipping invalid user id during migration: {user_id_str}")
+            continue
+        rows.append((
+            user_id,
+            user_data.get('username') or "",
+            user_data.get('first_name') or "",
+            user_data.get('last_name') or "",
+            user_data.get('last_seen'),
+            user_data.get('joined_date')
+        ))
+    
+    with db:
+        db.executemany(
+            "INSERT OR IGNORE INTO users "
+            "(user_id, username, first_name, last_name, last_seen, joined_date) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
     
-    def set_channels(self, data):
-        self._channels = data.copy() if data else {}
-        self._channels_time = datetime.now()
+    # Переименовываем, чтобы миграция не запускалась повторно
+    os.replace(USERS_FILE, USERS_FILE + '.migrated')
+    logger.info(f"Migrated {len(rows)} users from {USERS_FILE} to {DB_FILE}")
+    return len(rows)
+
+def migrate_submissions_json(db: sqlite3.Connection) -> int:
+    """Одноразовый перенос submissions.json в базу"""
+    if not os.path.exists(SUBMISSIONS_FILE):
+        return 0
     
-    # Каналы рассылки
-    def get_broadcast(self):
-        if self._broadcast and self._is_valid(self._broadcast_time):
-            return self._broadcast.copy()
-        return None
+    try:
+        with open(SUBMISSIONS_FILE, 'r', encoding='utf-8') as f:
+            submissions = json.load(f)
+    except Exception as e:
+        logger.error(f"Error reading {SUBMISSIONS_FILE} for migration: {e}")
+        return 0
     
-    def set_broadcast(self, data):
-        self._broadcast = data.copy() if data else {}
-        self._broadcast_time = datetime.now()
+    rows = []
+    for user_id_str, user_submissions in submissions.items():
+        try:
+            user_id = int(user_id_str)
+        except ValueError:
+            logger.warning(f"Skipping invalid user id during migration: {user_id_str}")
+            continue
+        rows.extend(
+            (user_id, channel_id, None)
+            for channel_id, is_submitted in user_submissions.items() if is_submitted
+        )
     
-    # Заявки
-    def get_submissions(self):
-        if self._submissions and self._is_valid(self._submissions_time):
-            return self._submissions.copy()
-        return None
+    with db:
+        db.executemany(
+            "INSERT OR IGNORE INTO submissions (user_id, channel_id, submitted_at) VALUES (?, ?, ?)",
+            rows
+        )
     
-    def set_submissions(self, data):
-        self._submissions = data.copy() if data else {}
-        self._submissions_time = datetime.now()
+    os.replace(SUBMISSIONS_FILE, SUBMISSIONS_FILE + '.migrated')
+    logger.info(f"Migrated {len(rows)} submissions from {SUBMISSIONS_FILE} to {DB_FILE}")
+    return len(rows)
 
-cache = Cache()
+_UPSERT_USER_SQL = (
+    "INSERT INTO users "
+    "(user_id, username, first_name, last_name, last_seen, joined_date) "
+    "VALUES (?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET "
+    "username = excluded.username, "
+    "first_name = excluded.first_name, "
+    "last_name = excluded.last_name, "
+    "last_seen = excluded.last_seen, "
+    # Написал боту - значит снова доступен для рассылок
+    "active = 1"
+)
 
-# ===== ФУНКЦИИ ИЗ ВАШЕГО ФАЙЛА (БЕЗ ИЗМЕНЕНИЙ) =====
-def load_users() -> Dict:
-    cached = cache.get_users()
-    if cached is not None:
-        return cached
+def _upsert_users(rows: List[tuple]) -> Dict[int, tuple]:
+    """Записывает пользователей и возвращает прежние (last_seen, active)
+    тех, кто уже был в базе - по ним обновляется статистика"""
+    previous = {}
+    with get_db() as db:
+        # Не больше 500 параметров в запросе, старые SQLite ограничены 999
+        for start in range(0, len(rows), 500):
+            user_ids = [row[0] for row in rows[start:start + 500]]
+            placeholders = ", ".join("?" * len(user_ids))
+            for row in db.execute(
+                f"SELECT user_id, last_seen, active FROM users WHERE user_id IN ({placeholders})",
+                user_ids
+            ):
+                previous[row['user_id']] = (row['last_seen'], row['active'])
+        db.executemany(_UPSERT_USER_SQL, rows)
+    return previous
+
+def _select_user_stats(since_day: str, recent_limit: int) -> tuple:
+    """Исходные данные для UserStats: итоги, активность по дням, новые"""
+    db = get_db()
+    total, unreachable = db.execute(
+        "SELECT COUNT(*), COALESCE(SUM(active = 0), 0) FROM users"
+    ).fetchone()
+    seen_days = {
+        row[0]: row[1] for row in db.execute(
+            "SELECT substr(last_seen, 1, 10) AS day, COUNT(*) FROM users "
+            "WHERE last_seen >= ? GROUP BY day",
+            (since_day,)
+        )
+    }
+    recent = [
+        (row['user_id'], row['username'], row['first_name']) for row in db.execute(
+            "SELECT user_id, username, first_name FROM users ORDER BY joined_date DESC LIMIT ?",
+            (recent_limit,)
+        )
+    ]
+    return total, unreachable, seen_days, recent
+
+def _deactivate_users(user_ids: List[int]) -> int:
+    with get_db() as db:
+        cursor = db.executemany(
+            "UPDATE users SET active = 0 WHERE user_id = ? AND active = 1",
+            [(user_id,) for user_id in user_ids]
+        )
+    return cursor.rowcount
+
+def _count_users(active_only: bool = False) -> int:
+    sql = "SELECT COUNT(*) FROM users"
+    if active_only:
+        sql += " WHERE active = 1"
+    return get_db().execute(sql).fetchone()[0]
+
+def _audience_filter(segment: str) -> tuple:
+    """WHERE для активных пользователей сегмента и его параметры.
+    Даты хранятся в ISO-формате, поэтому сравниваются как строки по индексу."""
+    _, column, days = AUDIENCE_SEGMENTS[segment]
+    if column is None:
+        return "active = 1", ()
+    since = (datetime.now() - timedelta(days=days)).isoformat()
+    return f"active = 1 AND {column} >= ?", (since,)
+
+def _count_audience(segment: str) -> int:
+    where, params = _audience_filter(segment)
+    return get_db().execute(f"SELECT COUNT(*) FROM users WHERE {where}", params).fetchone()[0]
+
+def _select_user_submissions(user_id: int) -> frozenset:
+    rows = get_db().execute(
+        "SELECT channel_id FROM submissions WHERE user_id = ?", (user_id,)
+    ).fetchall()
+    return frozenset(row['channel_id'] for row in rows)
+
+def _insert_submission(user_id: int, channel_id: str, submitted_at: str):
+    with get_db() as db:
+        db.execute(
+            "INSERT OR IGNORE INTO submissions (user_id, channel_id, submitted_at) VALUES (?, ?, ?)",
+            (user_id, channel_id, submitted_at)
+        )
+
+def _delete_all_submissions():
+    with get_db() as db:
+        db.execute("DELETE FROM submissions")
+
+# Статусы получателя рассылки. CLAIMED ставится до отправки: если бот
+# упадет посреди запроса, такой получатель не получит сообщение повторно.
+RECIPIENT_PENDING, RECIPIENT_CLAIMED, RECIPIENT_SENT, RECIPIENT_FAILED, RECIPIENT_UNREACHABLE = range(5)
+
+def _create_delivery_job(kind: str, message_json: str, chat_ids: Optional[List[int]],
+                         progress_chat_id: int, progress_message_id: int, segment: str = 'all') -> int:
+    """chat_ids=None - активные пользователи сегмента. Они копируются
+    в получатели внутри базы, не проходя через память бота."""
+    with get_db() as db:
+        cursor = db.execute(
+            "INSERT INTO delivery_jobs "
+            "(kind, message, status, progress_chat_id, progress_message_id, created_at) "
+            "VALUES (?, ?, 'running', ?, ?, ?)",
+            (kind, message_json, progress_chat_id, progress_message_id, datetime.now().isoformat())
+        )
+        job_id = cursor.lastrowid
+        # Первичный ключ (job_id, chat_id) не дает отправить одному чату дважды
+        if chat_ids is None:
+            where, params = _audience_filter(segment)
+            db.execute(
+                "INSERT OR IGNORE INTO delivery_recipients (job_id, chat_id) "
+                f"SELECT ?, user_id FROM users WHERE {where}",
+                (job_id, *params)
+            )
+        else:
+            db.executemany(
+                "INSERT OR IGNORE INTO delivery_recipients (job_id, chat_id) VALUES (?, ?)",
+                ((job_id, chat_id) for chat_id in chat_ids)
+            )
+        db.execute(
+            "UPDATE delivery_jobs SET total = "
+            "(SELECT COUNT(*) FROM delivery_recipients WHERE job_id = ?) WHERE job_id = ?",
+            (job_id, job_id)
+        )
+    return job_id
+
+def _select_delivery_job(job_id: int) -> Optional[sqlite3.Row]:
+    return get_db().execute("SELECT * FROM delivery_jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+# Незавершенные рассылки: running, paused и cancelling (отмена запрошена,
+# но владелец еще не остановился)
+_UNFINISHED_JOBS_SQL = "status IN ('running', 'paused', 'cancelling')"
+
+def _select_unfinished_delivery_jobs() -> List[sqlite3.Row]:
+    return get_db().execute(
+        f"SELECT * FROM delivery_jobs WHERE {_UNFINISHED_JOBS_SQL} ORDER BY job_id"
+    ).fetchall()
+
+def _set_delivery_job_status(job_id: int, status: str) -> bool:
+    """Меняет статус, только если рассылка еще идет или на паузе"""
+    with get_db() as db:
+        cursor = db.execute(
+            "UPDATE delivery_jobs SET status = ? WHERE job_id = ? AND status IN ('running', 'paused')",
+            (status, job_id)
+        )
+    return cursor.rowcount > 0
+
+def _renew_lease(db: sqlite3.Connection, name: str, owner: str, ttl: float) -> bool:
+    now = time.time()
+    db.execute(
+        "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+        "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+        (name, owner, now + ttl, now)
+    )
+    row = db.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+    return row['owner'] == owner
+
+def _acquire_lease(name: str, owner: str, ttl: float) -> bool:
+    """Берет или продлевает аренду. False - ее держит другой процесс."""
+    with get_db() as db:
+        return _renew_lease(db, name, owner, ttl)
+
+def _release_lease(name: str, owner: str):
+    with get_db() as db:
+        db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+def _delivery_heartbeat(job_id: int, lease: str, owner: str, ttl: float,
+                        sent: int, failed: int, rate: float) -> tuple:
+    """Продлевает аренду рассылки и сохраняет прогресс.
+    Возвращает (аренда за нами, текущий статус рассылки)."""
+    with get_db() as db:
+        owned = _renew_lease(db, lease, owner, ttl)
+        if owned:
+            db.execute(
+                "UPDATE delivery_jobs SET sent = ?, failed = ?, rate = ? WHERE job_id = ?",
+                (sent, failed, rate, job_id)
+            )
+        row = db.execute("SELECT status FROM delivery_jobs WHERE job_id = ?", (job_id,)).fetchone()
+    return owned, row['status']
+
+def _lease_owned(db: sqlite3.Connection, name: str, owner: str) -> bool:
+    """Проверка аренды внутри транзакции. BEGIN IMMEDIATE сразу берет блокировку
+    записи, так что до конца транзакции аренду не перехватит другой процесс."""
+    db.execute("BEGIN IMMEDIATE")
+    row = db.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+    return row is not None and row['owner'] == owner
+
+def _claim_recipients(job_id: int, lease: str, owner: str, after: int, limit: int) -> Optional[List[int]]:
+    """Следующая страница ожидающих получателей, сразу помеченная как взятая.
+    None - аренду рассылки держит другой процесс."""
+    with get_db() as db:
+        if not _lease_owned(db, lease, owner):
+            return None
+        # Один запрос: получатель, которого уже взял кто-то другой,
+        # не попадет в страницу дважды
+        rows = db.execute(
+            "UPDATE delivery_recipients SET status = ? "
+            "WHERE job_id = ? AND status = ? AND chat_id IN ("
+            "SELECT chat_id FROM delivery_recipients "
+            "WHERE job_id = ? AND chat_id > ? AND status = ? ORDER BY chat_id LIMIT ?"
+            ") RETURNING chat_id",
+            (RECIPIENT_CLAIMED, job_id, RECIPIENT_PENDING, job_id, after, RECIPIENT_PENDING, limit)
+        ).fetchall()
+    # RETURNING не гарантирует порядок строк
+    return sorted(row['chat_id'] for row in rows)
+
+def _release_claimed_recipients(job_id: int, lease: str, owner: str) -> int:
+    """Возвращает в очередь взятых получателей, отправка которым точно
+    не начиналась. Только пока аренда за нами: иначе взятые - чужие."""
+    with get_db() as db:
+        if not _lease_owned(db, lease, owner):
+            return 0
+        return db.execute(
+            "UPDATE delivery_recipients SET status = ? WHERE job_id = ? AND status = ?",
+            (RECIPIENT_PENDING, job_id, RECIPIENT_CLAIMED)
+        ).rowcount
+
+def _record_recipient_statuses(job_id: int, outcomes: List[tuple]):
+    with get_db() as db:
+        db.executemany(
+            "UPDATE delivery_recipients SET status = ? WHERE job_id = ? AND chat_id = ?",
+            [(status, job_id, chat_id) for chat_id, status in outcomes]
+        )
+
+def _count_recipient_statuses(job_id: int) -> Dict[int, int]:
+    rows = get_db().execute(
+        "SELECT status, COUNT(*) FROM delivery_recipients WHERE job_id = ? GROUP BY status",
+        (job_id,)
+    ).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+def _select_recipients_with_status(job_id: int, status: int) -> List[int]:
+    rows = get_db().execute(
+        "SELECT chat_id FROM delivery_recipients WHERE job_id = ? AND status = ?",
+        (job_id, status)
+    ).fetchall()
+    return [row['chat_id'] for row in rows]
+
+def _finish_delivery_job(job_id: int, status: str, sent: int, failed: int):
+    with get_db() as db:
+        db.execute(
+            "UPDATE delivery_jobs SET status = ?, finished_at = ?, sent = ?, failed = ? WHERE job_id = ?",
+            (status, datetime.now().isoformat(), sent, failed, job_id)
+        )
+
+# ===== АСИНХРОННЫЙ ВВОД-ВЫВОД =====
+class AsyncStorage:
+    """Выполняет дисковые операции в отдельном пуле потоков.
+    Операции с одним ресурсом (файлом или базой) идут строго по очереди."""
+    def __init__(self, max_workers: int = 2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='storage')
+        self._locks: Dict[str, asyncio.Lock] = {}
+    
+    def _lock(self, resource: str) -> asyncio.Lock:
+        lock = self._locks.get(resource)
+        if lock is None:
+            lock = self._locks[resource] = asyncio.Lock()
+        return lock
+    
+    async def run(self, resource: str, func, *args):
+        # asyncio.Lock будит ожидающих в порядке очереди, поэтому
+        # записи в один файл выполняются в том порядке, в котором пришли
+        async with self._lock(resource):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+    
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+storage = AsyncStorage()
+
+class KeyedLocks:
+    """asyncio.Lock на каждый ключ (например, пользователя). Замок живет,
+    пока его кто-то держит или ждет, поэтому память не растет."""
+    def __init__(self):
+        self._locks: Dict = {}
+    
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+def _backup_path(path: str, n: int) -> str:
+    return f"{path}.bak{n}"
+
+def _load_json_file(path: str) -> Dict:
+    """Читает и проверяет файл данных: словарь записей-словарей"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or not all(isinstance(value, dict) for value in data.values()):
+        raise ValueError(f"unexpected structure in {path}")
+    return data
+
+def _read_json(path: str, default: Dict):
+    """Возвращает данные и отпечаток файла, с которого они прочитаны.
+    Поврежденный файл не превращается в пустые данные: берется самая
+    свежая целая резервная копия, а если целых нет - ошибка."""
+    signature = _file_signature(path)
+    if signature is None:
+        return default, None
     
     try:
-        if os.path.exists(USERS_FILE):
-            with open(USERS_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        else:
-            data = {}
-    except Exception as e:
-        logger.error(f"Error loading users: {e}")
-        data = {}
-    
-    cache.set_users(data)
-    return data.copy()
-
-def save_user(user_id: int, username: str, first_name: str, last_name: str = ""):
-    users = load_users()
-    user_id_str = str(user_id)
-    
-    users[user_id_str] = {
-        'username': username or "",
-        'first_name': first_name or "",
-        'last_name': last_name or "",
-        'last_seen': datetime.now().isoformat(),
-        'joined_date': users.get(user_id_str, {}).get('joined_date', datetime.now().isoformat())
-    }
+        return _load_json_file(path), signature
+    except (ValueError, UnicodeDecodeError) as e:
+        logger.error(f"{path} is corrupted: {e}")
     
+    for n in range(1, JSON_BACKUP_COUNT + 1):
+        backup = _backup_path(path, n)
+        try:
+            data = _load_json_file(backup)
+        except FileNotFoundError:
+            break
+        except (ValueError, UnicodeDecodeError) as e:
+            logger.error(f"{backup} is corrupted too: {e}")
+            continue
+        logger.warning(f"Recovered {path} from {backup}")
+        return data, signature
+    
+    raise ValueError(f"{path} and its backups are unreadable")
+
+def _write_json(path: str, data: Dict) -> Optional[tuple]:
+    """Атомарная запись: временный файл, fsync, rename. Перед заменой
+    текущая версия уходит в резервные копии (.bak1 - самая свежая)."""
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        
+        if os.path.exists(path):
+            for n in range(JSON_BACKUP_COUNT, 1, -1):
+                if os.path.exists(_backup_path(path, n - 1)):
+                    os.replace(_backup_path(path, n - 1), _backup_path(path, n))
+            # Жесткая ссылка: сам файл на месте все время, пока пишем
+            if os.path.exists(_backup_path(path, 1)):
+                os.remove(_backup_path(path, 1))
+            os.link(path, _backup_path(path, 1))
+        
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    
+    # Переименование должно пережить сбой питания
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return _file_signature(path)
+
+def _modify_json(path: str, default: Dict, modify) -> tuple:
+    """Транзакция над файлом: modify(data) получает свежие данные под
+    межпроцессной блокировкой и возвращает (changes, result), где changes -
+    правки ключей (None - удалить ключ). Между чтением и записью никто
+    не вклинится, поэтому правки других обработчиков и процессов
+    не теряются. Возвращает новые данные, отпечаток файла и result."""
+    with open(path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            data, signature = _read_json(path, default)
+            changes, result = modify(MappingProxyType(data))
+            if not changes:
+                return data, signature, result
+            
+            data = dict(data)
+            for key, value in changes.items():
+                if value is None:
+                    data.pop(key, None)
+                else:
+                    data[key] = value
+            return data, _write_json(path, data), result
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# ===== ПОЛЬЗОВАТЕЛИ =====
+class UserWriteBuffer:
+    """Буфер отложенной записи пользователей (last_seen и профиль)"""
+    def __init__(self, max_pending: int = USER_FLUSH_MAX_PENDING):
+        self._pending: Dict[int, tuple] = {}
+        self.max_pending = max_pending
+    
+    def __len__(self):
+        return len(self._pending)
+    
+    def add(self, user_id: int, username: str, first_name: str, last_name: str) -> bool:
+        """Добавляет запись, повторные обращения одного пользователя склеиваются.
+        Возвращает True, если буфер пора сбросить."""
+        now = datetime.now().isoformat()
+        previous = self._pending.get(user_id)
+        joined_date = previous[5] if previous else now
+        self._pending[user_id] = (user_id, username, first_name, last_name, now, joined_date)
+        return len(self._pending) >= self.max_pending
+    
+    async def flush(self) -> int:
+        """Записывает накопленное одной транзакцией"""
+        if not self._pending:
+            return 0
+        
+        rows = list(self._pending.values())
+        self._pending = {}
+        
+        try:
+            previous = await storage.run(DB_FILE, _upsert_users, rows)
+        except Exception as e:
+            logger.error(f"Error flushing {len(rows)} users: {e}")
+            # Возвращаем в буфер, не затирая более свежие записи
+            for row in rows:
+                self._pending.setdefault(row[0], row)
+            return 0
+        
+        user_stats.apply(rows, previous)
+        return len(rows)
+
+user_buffer = UserWriteBuffer()
+
+class UserStats:
+    """Статистика пользователей без чтения всей таблицы. Загружается один раз
+    при старте, дальше обновляется при каждой записи пользователей.
+    Активность хранится счетчиками по дням последнего визита за window_days."""
+    def __init__(self, window_days: int = 30, recent_size: int = 5):
+        self.window_days = window_days
+        self.total = 0
+        self.unreachable = 0
+        self._seen_days: Dict[str, int] = {}
+        # (user_id, username, first_name), самые новые слева
+        self.recent = deque(maxlen=recent_size)
+    
+    def _since_day(self, days: int) -> str:
+        return (datetime.now() - timedelta(days=days)).date().isoformat()
+    
+    async def load(self):
+        total, unreachable, seen_days, recent = await storage.run(
+            DB_FILE, _select_user_stats, self._since_day(self.window_days), self.recent.maxlen
+        )
+        self.total = total
+        self.unreachable = unreachable
+        self._seen_days = seen_days
+        self.recent = deque(recent, maxlen=self.recent.maxlen)
+    
+    def apply(self, rows: List[tuple], previous: Dict[int, tuple]):
+        """Учитывает записанные строки UserWriteBuffer"""
+        for user_id, username, first_name, _, last_seen, _ in rows:
+            if user_id in previous:
+                old_last_seen, old_active = previous[user_id]
+                old_day = old_last_seen[:10] if old_last_seen else None
+                # Дни старше окна уже не хранятся
+                if old_day in self._seen_days:
+                    self._seen_days[old_day] -= 1
+                    if not self._seen_days[old_day]:
+                        del self._seen_days[old_day]
+                if not old_active:
+                    self.unreachable -= 1
+                for i, (recent_id, _, _) in enumerate(self.recent):
+                    if recent_id == user_id:
+                        self.recent[i] = (user_id, username, first_name)
+            else:
+                self.total += 1
+                self.recent.appendleft((user_id, username, first_name))
+            
+            day = last_seen[:10]
+            self._seen_days[day] = self._seen_days.get(day, 0) + 1
+    
+    def seen_within(self, days: int) -> int:
+        """Сколько пользователей заходили за последние days дней (days <= window_days)"""
+        horizon = self._since_day(self.window_days)
+        for day in [day for day in self._seen_days if day < horizon]:
+            del self._seen_days[day]
+        since = self._since_day(days)
+        return sum(count for day, count in self._seen_days.items() if day >= since)
+
+user_stats = UserStats()
+
+async def reload_user_stats_job(context: ContextTypes.DEFAULT_TYPE):
+    """Подтягивает в статистику пользователей, записанных другими процессами"""
+    await user_buffer.flush()
+    await user_stats.load()
+
+async def save_user(user_id: int, username: str, first_name: str, last_name: str = ""):
+    if user_buffer.add(user_id, username or "", first_name or "", last_name or ""):
+        await user_buffer.flush()
+
+async def flush_users_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодический сброс буфера пользователей"""
+    await user_buffer.flush()
+
+async def deactivate_users(user_ids) -> int:
+    """Отмечает недоступных пользователей одним запросом, рассылки их пропускают"""
     try:
-        with open(USERS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(users, f, ensure_ascii=False, indent=2)
-        cache.set_users(users)
+        deactivated = await storage.run(DB_FILE, _deactivate_users, [int(user_id) for user_id in user_ids])
+        user_stats.unreachable += deactivated
+        return deactivated
     except Exception as e:
-        logger.error(f"Error saving user: {e}")
-        cache.invalidate_users()
+        logger.error(f"Error deactivating users: {e}")
+        return 0
 
-def get_user_count() -> int:
-    users = load_users()
-    return len(users)
+async def get_audience_count(segment: str) -> int:
+    try:
+        return await storage.run(DB_FILE, _count_audience, segment)
+    except Exception as e:
+        logger.error(f"Error counting audience {segment}: {e}")
+        return 0
 
-# ===== КАНАЛЫ ДЛЯ ПОДПИСКИ =====
-def load_channels() -> Dict:
-    cached = cache.get_channels()
-    if cached is not None:
-        return cached
-    
+async def get_user_count(active_only: bool = False) -> int:
     try:
-        if os.path.exists(CHANNELS_FILE):
-            with open(CHANNELS_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        else:
-            data = {
-                "1": {"name": "Канал №1", "link": "https://t.me/+k1eBaFb3N8FkYmM6"},
-                "2": {"name": "Канал №2", "link": "https://t.me/+nQNnRAQuXkxmODky"}
-            }
+        return await storage.run(DB_FILE, _count_users, active_only)
     except Exception as e:
-        logger.error(f"Error loading channels: {e}")
-        data = {}
-    
-    cache.set_channels(data)
-    return data.copy()
+        logger.error(f"Error counting users: {e}")
+        return 0
 
-def save_channels(channels: Dict):
+async def _modify_section(name: str, path: str, default: Dict, modify):
+    """Выполняет _modify_json для раздела и кладет в кэш то, что получилось
+    в файле (вместе с правками других процессов). modify выполняется
+    в потоке хранилища и не должен ничего ждать.
+    Возвращает result из modify или None при ошибке."""
     try:
-        with open(CHANNELS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(channels, f, ensure_ascii=False, indent=2)
-        cache.set_channels(channels)
+        data, signature, result = await storage.run(path, _modify_json, path, default, modify)
+        cache.set(name, data, signature)
+        return result
     except Exception as e:
-        logger.error(f"Error saving channels: {e}")
-        cache.set_channels({})
+        logger.error(f"Error saving {path}: {e}")
+        cache.invalidate(name)
+        return None
 
-# ===== КАНАЛЫ ДЛЯ РАССЫЛКИ =====
-def load_broadcast_channels() -> Dict:
-    cached = cache.get_broadcast()
+async def _load_section(name: str, path: str, default: Dict) -> Mapping:
+    """Раздел из кэша, а если его там нет или файл изменился - из файла"""
+    cached = cache.get(name)
     if cached is not None:
         return cached
     
     try:
-        if os.path.exists(BROADCAST_CHANNELS_FILE):
-            with open(BROADCAST_CHANNELS_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        else:
-            data = {}
+        data, signature = await storage.run(path, _read_json, path, default)
     except Exception as e:
-        logger.error(f"Error loading broadcast channels: {e}")
-        data = {}
+        # Пустой результат не кэшируем, чтобы не выдать его за данные
+        logger.error(f"Error loading {path}: {e}")
+        return MappingProxyType({})
     
-    cache.set_broadcast(data)
-    return data.copy()
+    return cache.set(name, data, signature)
 
-def save_broadcast_channel(chat_id: int, chat_title: str) -> bool:
-    try:
-        channels = load_broadcast_channels()
-        chat_id_str = str(chat_id)
-        
+# ===== КАНАЛЫ ДЛЯ ПОДПИСКИ =====
+async def load_channels() -> Mapping:
+    return await _load_section('channels', CHANNELS_FILE, DEFAULT_CHANNELS)
+
+async def add_channel(channel_data: Dict) -> Optional[str]:
+    """Добавляет канал под новым ID и возвращает этот ID"""
+    def modify(channels):
+        new_id = str(max((int(key) for key in channels if key.isdigit()), default=0) + 1)
+        return {new_id: channel_data}, new_id
+    
+    return await _modify_section('channels', CHANNELS_FILE, DEFAULT_CHANNELS, modify)
+
+async def delete_channel(channel_id: str) -> Optional[Dict]:
+    """Удаляет канал и возвращает его данные (None - канала не было)"""
+    def modify(channels):
+        channel_data = channels.get(channel_id)
+        return ({channel_id: None} if channel_data is not None else {}), channel_data
+    
+    return await _modify_section('channels', CHANNELS_FILE, DEFAULT_CHANNELS, modify)
+
+# ===== КАНАЛЫ ДЛЯ РАССЫЛКИ =====
+async def load_broadcast_channels() -> Mapping:
+    return await _load_section('broadcast', BROADCAST_CHANNELS_FILE, {})
+
+async def save_broadcast_channel(chat_id: int, chat_title: str) -> bool:
+    """Сохраняет канал, права в котором только что проверены"""
+    chat_id_str = str(chat_id)
+    
+    def modify(channels):
         if chat_id_str in channels:
-            channels[chat_id_str]['title'] = chat_title
-            channels[chat_id_str]['last_updated'] = datetime.now().isoformat()
+            channel_data = dict(
+                channels[chat_id_str],
+                title=chat_title,
+                last_updated=datetime.now().isoformat(),
+                has_access=True,
+                last_checked=datetime.now().isoformat()
+            )
         else:
-            channels[chat_id_str] = {
+            channel_data = {
                 'title': chat_title,
                 'added_date': datetime.now().isoformat(),
                 'last_updated': datetime.now().isoformat(),
-                'has_access': True
+                'has_access': True,
+                'last_checked': datetime.now().isoformat()
             }
-        
-        with open(BROADCAST_CHANNELS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(channels, f, ensure_ascii=False, indent=2)
-        
-        cache.set_broadcast(channels)
-        return True
-    except Exception as e:
-        logger.error(f"Error saving broadcast channel: {e}")
-        return False
+        return {chat_id_str: channel_data}, True
+    
+    return await _modify_section('broadcast', BROADCAST_CHANNELS_FILE, {}, modify) is not None
+
+async def remove_inaccessible_channels() -> Optional[tuple]:
+    """Удаляет каналы без доступа. Возвращает (осталось, удалено)."""
+    def modify(channels):
+        removed = [chat_id_str for chat_id_str, info in channels.items() if not info.get('has_access')]
+        return {chat_id_str: None for chat_id_str in removed}, (len(channels) - len(removed), len(removed))
+    
+    return await _modify_section('broadcast', BROADCAST_CHANNELS_FILE, {}, modify)
 
 # ===== ЗАЯВКИ =====
-def load_submissions() -> Dict:
-    cached = cache.get_submissions()
-    if cached is not None:
-        return cached
+class SubmissionsIndex:
+    """Заявки по пользователям: в памяти держим только недавно
+    обращавшихся (LRU) и не дольше ttl секунд, в базе читаем и пишем
+    строки одного пользователя"""
+    def __init__(self, max_users: int = SUBMISSIONS_CACHE_SIZE, ttl: float = SUBMISSIONS_CACHE_TTL):
+        self._users: OrderedDict = OrderedDict()
+        self.max_users = max_users
+        self.ttl = ttl
+    
+    def get(self, user_id: int) -> Optional[frozenset]:
+        entry = self._users.get(user_id)
+        if entry is None:
+            return None
+        loaded, channel_ids = entry
+        if time.monotonic() - loaded > self.ttl:
+            del self._users[user_id]
+            return None
+        self._users.move_to_end(user_id)
+        return channel_ids
+    
+    def put(self, user_id: int, channel_ids: frozenset):
+        self._users[user_id] = (time.monotonic(), channel_ids)
+        self._users.move_to_end(user_id)
+        if len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+    
+    def clear(self):
+        self._users.clear()
+
+submissions_index = SubmissionsIndex()
+# Чтение и запись заявок одного пользователя идут по очереди, иначе
+# медленное чтение может положить в индекс набор без свежей заявки
+submission_locks = KeyedLocks()
+
+async def _load_user_submissions(user_id: int) -> Optional[frozenset]:
+    """Вызывается под submission_locks"""
+    channel_ids = submissions_index.get(user_id)
+    if channel_ids is not None:
+        return channel_ids
     
     try:
-        if os.path.exists(SUBMISSIONS_FILE):
-            with open(SUBMISSIONS_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        else:
-            data = {}
+        channel_ids = await storage.run(DB_FILE, _select_user_submissions, user_id)
     except Exception as e:
-        logger.error(f"Error loading submissions: {e}")
-        data = {}
+        logger.error(f"Error loading submissions for {user_id}: {e}")
+        return None
     
-    cache.set_submissions(data)
-    return data.copy()
+    submissions_index.put(user_id, channel_ids)
+    return channel_ids
+
+async def get_user_submissions(user_id: int) -> frozenset:
+    """ID каналов, в которые пользователь подал заявку"""
+    channel_ids = submissions_index.get(user_id)
+    if channel_ids is not None:
+        return channel_ids
+    
+    async with submission_locks.hold(user_id):
+        return await _load_user_submissions(user_id) or frozenset()
+
+async def mark_submitted(user_id: int, channel_id: str):
+    async with submission_locks.hold(user_id):
+        channel_ids = await _load_user_submissions(user_id)
+        if channel_ids is not None and channel_id in channel_ids:
+            return
+        
+        try:
+            await storage.run(DB_FILE, _insert_submission, user_id, channel_id, datetime.now().isoformat())
+        except Exception as e:
+            logger.error(f"Error saving submission {user_id}/{channel_id}: {e}")
+            return
+        
+        if channel_ids is not None:
+            submissions_index.put(user_id, channel_ids | {channel_id})
 
-def save_submissions(submissions: Dict):
+async def reset_submissions():
     try:
-        with open(SUBMISSIONS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(submissions, f, ensure_ascii=False, indent=2)
-        cache.set_submissions(submissions)
+        await storage.run(DB_FILE, _delete_all_submissions)
     except Exception as e:
-        logger.error(f"Error saving submissions: {e}")
-        cache.set_submissions({})
+        logger.error(f"Error resetting submissions: {e}")
+    submissions_index.clear()
 
 # ===== ВАЖНЫЕ ФУНКЦИИ ИЗ ВАШЕГО ФАЙЛА =====
+_bot_user: Optional[User] = None
+
+async def get_bot_user(bot) -> User:
+    """Профиль бота: запрашивается один раз и дальше берется из памяти"""
+    global _bot_user
+    if _bot_user is None:
+        _bot_user = await bot.get_me()
+    return _bot_user
+
 async def check_bot_permissions(chat_id: int, context) -> bool:
-    """Проверка прав бота в канале (полная версия)"""
+    """Проверка прав бота в канале (полная версия).
+    False - только если доступа точно нет: бот не админ, удален из канала
+    или канал не найден. Временные ошибки (сеть, RetryAfter) пробрасываются
+    наверх: по ним нельзя судить о доступе."""
+    me = await get_bot_user(context.bot)
     try:
-        me = await context.bot.get_me()
         bot_member = await context.bot.get_chat_member(chat_id, me.id)
-        return bot_member.status in ['administrator', 'creator']
-    except Exception as e:
-        logger.error(f"Error checking permissions for chat {chat_id}: {e}")
+    except (Forbidden, BadRequest) as e:
+        if classify_send_error(e) != SEND_ERROR_UNREACHABLE:
+            raise
+        logger.warning(f"No access to chat {chat_id}: {e}")
         return False
+    return bot_member.status in ['administrator', 'creator']
 
-async def get_accessible_channels(context) -> Dict:
-    """Получение списка доступных каналов (полная версия)"""
+def _access_is_stale(channel_info: Mapping, max_age: float) -> bool:
+    last_checked = channel_info.get('last_checked')
+    if not last_checked:
+        return True
     try:
-        channels = load_broadcast_channels()
-        accessible_channels = {}
+        checked = datetime.fromisoformat(last_checked)
+    except ValueError:
+        return True
+    return (datetime.now() - checked).total_seconds() > max_age
+
+def _only_accessible(channels: Mapping) -> Dict:
+    return {chat_id_str: info for chat_id_str, info in channels.items() if info.get('has_access')}
+
+async def get_cached_accessible_channels() -> Dict:
+    """Доступные каналы по сохраненному статусу, без запросов к Telegram.
+    Статус поддерживает свежим refresh_channel_access_job."""
+    return _only_accessible(await load_broadcast_channels())
+
+async def get_accessible_channels(context, on_progress=None, max_age: Optional[float] = None) -> Dict:
+    """Получение списка доступных каналов (полная версия).
+    Каналы проверяются параллельно, не больше PERMISSION_CHECK_CONCURRENCY
+    одновременно. on_progress(done, total) вызывается не чаще раза
+    в PERMISSION_PROGRESS_INTERVAL секунд. С max_age перепроверяются
+    только каналы, статус которых старше max_age секунд."""
+    try:
+        channels = await load_broadcast_channels()
+        if max_age is None:
+            to_check = list(channels)
+        else:
+            to_check = [chat_id_str for chat_id_str, info in channels.items()
+                        if _access_is_stale(info, max_age)]
+        total = len(to_check)
+        done = 0
+        semaphore = asyncio.Semaphore(PERMISSION_CHECK_CONCURRENCY)
+        # Общая пауза после RetryAfter: флуд-контроль действует на весь бот
+        resume_at = 0.0
+        last_report = time.monotonic()
         
-        for chat_id_str, channel_info in channels.items():
-            try:
-                chat_id = int(chat_id_str)
-                has_access = await check_bot_permissions(chat_id, context)
-                
-                if has_access:
-                    accessible_channels[chat_id_str] = channel_info
-                    channels[chat_id_str]['has_access'] = True
-                    channels[chat_id_str]['last_checked'] = datetime.now().isoformat()
-                else:
-                    channels[chat_id_str]['has_access'] = False
-                    channels[chat_id_str]['last_checked'] = datetime.now().isoformat()
-                    
-            except Exception as e:
-                logger.error(f"Error checking channel {chat_id_str}: {e}")
-                channels[chat_id_str]['has_access'] = False
+        async def probe(chat_id_str: str):
+            nonlocal done, resume_at, last_report
+            async with semaphore:
+                for attempt in range(PERMISSION_CHECK_RETRIES):
+                    delay = resume_at - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    try:
+                        result = await check_bot_permissions(int(chat_id_str), context)
+                        break
+                    except RetryAfter as e:
+                        logger.warning(f"Flood control while checking {chat_id_str}, retry in {e.retry_after}s")
+                        resume_at = max(resume_at, time.monotonic() + e.retry_after)
+                        result = e
+                    except Exception as e:
+                        result = e
+                        break
+            
+            done += 1
+            if on_progress and time.monotonic() - last_report >= PERMISSION_PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                try:
+                    await on_progress(done, total)
+                except Exception as e:
+                    logger.warning(f"Error reporting permission check progress: {e}")
+            return result
         
-        with open(BROADCAST_CHANNELS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(channels, f, ensure_ascii=False, indent=2)
+        results = await asyncio.gather(*(probe(chat_id_str) for chat_id_str in to_check))
         
-        cache.set_broadcast(channels)
-        return accessible_channels
+        checked = {}
+        for chat_id_str, has_access in zip(to_check, results):
+            if isinstance(has_access, Exception):
+                # Временный сбой: сохраненный статус оставляем как есть
+                logger.error(f"Error checking channel {chat_id_str}: {has_access}")
+            else:
+                checked[chat_id_str] = {'has_access': has_access, 'last_checked': datetime.now().isoformat()}
+        
+        # Пока шла проверка, каналы могли добавить, удалить или переименовать,
+        # поэтому поля статуса накладываются на текущие записи внутри транзакции
+        def modify(channels):
+            changes = {
+                chat_id_str: dict(channels[chat_id_str], **status)
+                for chat_id_str, status in checked.items() if chat_id_str in channels
+            }
+            return changes, None
+        
+        if checked:
+            await _modify_section('broadcast', BROADCAST_CHANNELS_FILE, {}, modify)
+        return _only_accessible(await load_broadcast_channels())
         
     except Exception as e:
         logger.error(f"Error in get_accessible_channels: {e}")
         return {}
 
+async def refresh_channel_access_job(context: ContextTypes.DEFAULT_TYPE):
+    """Фоновая перепроверка устаревших статусов доступа к каналам.
+    Из нескольких процессов бота ее выполняет один - владелец аренды."""
+    owned = await storage.run(
+        DB_FILE, _acquire_lease, 'channel_access_refresh', WORKER_ID, ACCESS_REFRESH_INTERVAL * 2
+    )
+    if owned:
+        await get_accessible_channels(context, max_age=ACCESS_STATUS_TTL)
+
 # ===== START (ПОЛНАЯ ВЕРСИЯ) =====
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user = update.effective_user
     user_id = user.id
     
-    save_user(user_id, user.username or "", user.first_name or "", user.last_name or "")
+    await save_user(user_id, user.username or "", user.first_name or "", user.last_name or "")
     
-    channels = load_channels()
+    channels = await load_channels()
     
     channel_list = "\n".join([f"- {data['name']}" for data in channels.values()])
     
     text = f"Чтобы пользоваться ботом, подпишитесь на каналы:\n\n{channel_list}"
     
-    await update.message.reply_text(text, reply_markup=make_user_keyboard(user_id))
+    await update.message.reply_text(text, reply_markup=await make_user_keyboard(user_id))
 
-def make_user_keyboard(user_id: int = None) -> InlineKeyboardMarkup:
+async def make_user_keyboard(user_id: int = None) -> InlineKeyboardMarkup:
     """Создание клавиатуры для пользователя"""
-    channels = load_channels()
-    submissions = load_submissions()
+    channels = await load_channels()
+    user_submissions = await get_user_submissions(user_id)
     keyboard = []
     
-    user_submissions = submissions.get(str(user_id), {})
-    
     for channel_id, channel_data in channels.items():
-        is_submitted = user_submissions.get(channel_id, False)
+        is_submitted = channel_id in user_submissions
         
         if is_submitted:
             button = InlineKeyboardButton(
@@ -358,15 +1279,14 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     
     if query.data == "check_submission":
-        submissions = load_submissions()
-        user_submissions = submissions.get(str(user.id), {})
-        channels = load_channels()
+        user_submissions = await get_user_submissions(user.id)
+        channels = await load_channels()
         
         all_submitted = True
         missing_channels = []
         
         for channel_id in channels:
-            if not user_submissions.get(channel_id, False):
+            if channel_id not in user_submissions:
                 all_submitted = False
                 missing_channels.append(channels[channel_id]['name'])
         
@@ -421,7 +1341,8 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("🗑 Удалить канал", callback_data="admin_delete")],
         [InlineKeyboardButton("👥 Сбросить заявки", callback_data="admin_reset")],
         [InlineKeyboardButton("📢 Управление рассылкой", callback_data="broadcast_panel_callback")],
-        [InlineKeyboardButton("👥 Оповещать пользователей", callback_data="notify_panel")]
+        [InlineKeyboardButton("👥 Оповещать пользователей", callback_data="notify_panel")],
+        [InlineKeyboardButton("📦 Активные рассылки", callback_data="jobs_list")]
     ]
     
     if update.message:
@@ -443,7 +1364,7 @@ async def admin_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         return NAME
     
     elif query.data == "admin_list":
-        channels = load_channels()
+        channels = await load_channels()
         
         if not channels:
             await query.message.reply_text("❌ Нет каналов.")
@@ -455,7 +1376,7 @@ async def admin_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.message.reply_text(f"📋 Каналы:\n\n{channel_list}")
     
     elif query.data == "admin_delete":
-        channels = load_channels()
+        channels = await load_channels()
         
         if not channels:
             await query.message.reply_text("❌ Нет каналов для удаления.")
@@ -475,7 +1396,7 @@ async def admin_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         )
     
     elif query.data == "admin_reset":
-        save_submissions({})
+        await reset_submissions()
         await query.message.reply_text("✅ Все заявки сброшены!")
     
     elif query.data == "broadcast_panel_callback":
@@ -491,12 +1412,10 @@ async def delete_channel_handler(update: Update, context: ContextTypes.DEFAULT_T
     
     if query.data.startswith('delete_'):
         channel_id = query.data.split('_')[1]
-        channels = load_channels()
+        channel_data = await delete_channel(channel_id)
         
-        if channel_id in channels:
-            channel_name = channels[channel_id]['name']
-            del channels[channel_id]
-            save_channels(channels)
+        if channel_data is not None:
+            channel_name = channel_data['name']
             await query.message.reply_text(f"✅ Канал «{channel_name}» удален!")
         else:
             await query.message.reply_text("❌ Канал не найден!")
@@ -510,15 +1429,14 @@ async def get_channel_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     channel_name = context.user_data['channel_name']
     channel_link = update.message.text
     
-    channels = load_channels()
-    new_id = str(len(channels) + 1)
-    
-    channels[new_id] = {
+    new_id = await add_channel({
         'name': channel_name,
         'link': channel_link
-    }
+    })
     
-    save_channels(channels)
+    if new_id is None:
+        await update.message.reply_text("❌ Не удалось сохранить канал, попробуйте еще раз.")
+        return ConversationHandler.END
     
     await update.message.reply_text(f"✅ Канал «{channel_name}» добавлен!")
     return ConversationHandler.END
@@ -536,17 +1454,749 @@ async def confirm_submission(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if query.data.startswith("confirm_"):
         channel_id = query.data.split("_")[1]
         
-        submissions = load_submissions()
-        user_id_str = str(user.id)
+        await mark_submitted(user.id, channel_id)
+        
+        await query.answer("✅ Заявка подтверждена!")
+        await query.edit_message_reply_markup(reply_markup=await make_user_keyboard(user.id))
+
+# ===== ОТПРАВКА С УЧЕТОМ ЛИМИТОВ =====
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, запас не больше capacity"""
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self, tokens: float = 1):
+        # Больше capacity ведро не накопит никогда
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+class RateLimiter:
+    """Общий лимит бота плюс интервал между сообщениями в один чат.
+    После RetryAfter все отправки ждут ровно столько, сколько просит Telegram."""
+    def __init__(self, global_rate: float = GLOBAL_SEND_RATE):
+        self.bucket = TokenBucket(global_rate)
+        self._chat_slots: Dict[int, float] = {}
+        self._paused_until = 0.0
+    
+    def _chat_interval(self, chat_id: int) -> float:
+        return GROUP_CHAT_SEND_INTERVAL if chat_id < 0 else PRIVATE_CHAT_SEND_INTERVAL
+    
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+    
+    async def acquire(self, chat_id: int, weight: int = 1):
+        """weight - сколько сообщений Telegram засчитает за запрос"""
+        now = time.monotonic()
+        if len(self._chat_slots) > 10000:
+            self._chat_slots = {k: v for k, v in self._chat_slots.items() if v > now}
         
-        if user_id_str not in submissions:
-            submissions[user_id_str] = {}
+        slot = max(now, self._chat_slots.get(chat_id, 0.0))
+        self._chat_slots[chat_id] = slot + self._chat_interval(chat_id)
+        if slot > now:
+            await asyncio.sleep(slot - now)
         
-        submissions[user_id_str][channel_id] = True
-        save_submissions(submissions)
+        # Пауза могла продлиться, пока мы ждали
+        while (delay := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
         
-        await query.answer("✅ Заявка подтверждена!")
-        await query.edit_message_reply_markup(reply_markup=make_user_keyboard(user.id))
+        await self.bucket.acquire(weight)
+
+send_limiter = RateLimiter()
+
+def _request_not_sent(error: NetworkError) -> bool:
+    """Запрос точно не дошел до Telegram: не удалось соединиться или
+    не хватило соединений в пуле. После таймаута чтения или обрыва
+    ответа сообщение могло уже быть доставлено."""
+    return isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+async def send_with_retry(chat_id: int, send, limiter: RateLimiter = send_limiter, weight: int = 1):
+    """Отправка через лимитер: send(chat_id) возвращает корутину запроса.
+    Повторяются RetryAfter и сетевые ошибки, при которых запрос точно
+    не ушел, остальные ошибки (в том числе TimedOut) сразу наверх."""
+    for attempt in range(SEND_RETRIES + 1):
+        await limiter.acquire(chat_id, weight)
+        try:
+            return await send(chat_id)
+        except RetryAfter as e:
+            if attempt == SEND_RETRIES:
+                raise
+            logger.warning(f"Flood control for {chat_id}, retry in {e.retry_after}s")
+            limiter.pause(e.retry_after)
+        except BadRequest:
+            # BadRequest наследуется от NetworkError, но повтор тут не поможет
+            raise
+        except NetworkError as e:
+            # Повтор после ушедшего запроса может прислать сообщение дважды
+            if attempt == SEND_RETRIES or not _request_not_sent(e):
+                raise
+            logger.warning(f"Network error sending to {chat_id}: {e}, retrying")
+            await asyncio.sleep(SEND_RETRY_BACKOFF * 2 ** attempt)
+
+# ===== ДВИЖОК РАССЫЛОК =====
+# Типы сообщений для подтверждения рассылки. animation раньше document:
+# у GIF заполнены оба поля
+MESSAGE_TYPES = (
+    'text', 'photo', 'video', 'animation', 'document', 'audio', 'voice',
+    'video_note', 'sticker', 'poll', 'location', 'venue', 'contact', 'dice'
+)
+
+# Рассылаем копией, поэтому подходит любое обычное сообщение
+BROADCAST_CONTENT_FILTER = filters.UpdateType.MESSAGE & ~filters.COMMAND & ~filters.StatusUpdate.ALL
+
+def capture_message(message: Message) -> Optional[Dict]:
+    """Ссылка на сообщение админа для рассылки через copy_message.
+    Исходное сообщение должно оставаться в чате до конца рассылки."""
+    message_type = next((name for name in MESSAGE_TYPES if getattr(message, name)), None)
+    if message_type is None:
+        return None
+    
+    captured = {
+        'type': message_type,
+        'chat_id': message.chat_id,
+        'message_id': message.message_id
+    }
+    if message.media_group_id:
+        captured['type'] = 'album'
+        captured['media_group_id'] = message.media_group_id
+        captured['message_ids'] = [message.message_id]
+    return captured
+
+def add_album_part(captured: Optional[Dict], message: Message) -> bool:
+    """Альбом приходит отдельными сообщениями: дописываем часть к уже
+    сохраненному альбому, если она из него"""
+    if not captured or not message.media_group_id:
+        return False
+    if captured.get('media_group_id') != message.media_group_id:
+        return False
+    # copy_messages требует id по возрастанию
+    captured['message_ids'] = sorted(captured['message_ids'] + [message.message_id])
+    return True
+
+def message_weight(message: Dict) -> int:
+    """Альбом через copy_messages Telegram считает как столько сообщений,
+    сколько в нем частей"""
+    return len(message.get('message_ids') or ()) or 1
+
+def make_sender(bot, message: Dict):
+    """send(chat_id) для сохраненного сообщения рассылки"""
+    
+    async def send(chat_id: int):
+        if 'message_id' not in message:
+            # Текст без исходного сообщения (/notify)
+            return await bot.send_message(
+                chat_id=chat_id,
+                text=message['content'],
+                disable_web_page_preview=message.get('disable_web_page_preview')
+            )
+        if message.get('message_ids'):
+            return await bot.copy_messages(
+                chat_id=chat_id,
+                from_chat_id=message['chat_id'],
+                message_ids=message['message_ids']
+            )
+        return await bot.copy_message(
+            chat_id=chat_id,
+            from_chat_id=message['chat_id'],
+            message_id=message['message_id']
+        )
+    
+    return send
+
+class DeliveryCancelled(Exception):
+    """Отправка не выполнена, потому что рассылку отменили"""
+
+class Delivery:
+    """Рассылка одного сообщения по списку чатов (пользователей или каналов).
+    Параллельность, темп, повторы и счетчики живут здесь, а вызывающий
+    код только выбирает получателей, сообщение и текст отчетов.
+    
+    Отправляют concurrency воркеров, которые берут следующий чат, как только
+    освободились, поэтому один медленный запрос не держит остальных.
+    
+    chat_ids может быть и асинхронным итератором. on_result(chat_id, error)
+    вызывается после каждой отправки (error=None при успехе). on_progress(delivery)
+    вызывается раз в progress_interval секунд из отдельной задачи, так что
+    медленное редактирование сообщения не задерживает отправку.
+    successful/failed - уже учтенные результаты, если рассылка продолжается.
+    weight - сколько сообщений в одной отправке (для общего лимита).
+    В failures для отчета остаются только первые DELIVERY_FAILURES_KEPT
+    ошибок в виде (chat_id, короткий текст), память от числа ошибок не растет.
+    
+    pause()/resume()/cancel() управляют рассылкой на ходу: состояние
+    проверяется уже после ожидания лимитера, прямо перед запросом."""
+    def __init__(self, chat_ids, send, concurrency: int = DELIVERY_CONCURRENCY,
+                 limiter: RateLimiter = send_limiter, on_progress=None,
+                 progress_interval: float = DELIVERY_PROGRESS_INTERVAL,
+                 total: Optional[int] = None, on_result=None, successful: int = 0, failed: int = 0,
+                 weight: int = 1):
+        self.chat_ids = chat_ids
+        self.send = send
+        self.weight = weight
+        self.concurrency = concurrency
+        self.limiter = limiter
+        self.on_progress = on_progress
+        self.progress_interval = progress_interval
+        self.on_result = on_result
+        self.total = total if total is not None else len(chat_ids)
+        self.successful = successful
+        self.failed = failed
+        self._resumed_from = successful + failed
+        self.failures: List[tuple] = []
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.cancelled = False
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+        self._paused_at: Optional[float] = None
+        self._paused_time = 0.0
+    
+    @property
+    def processed(self) -> int:
+        return self.successful + self.failed
+    
+    @property
+    def paused(self) -> bool:
+        return not self._resumed.is_set()
+    
+    @property
+    def elapsed(self) -> float:
+        """Время работы без учета пауз"""
+        if self.started is None:
+            return 0.0
+        end = self.finished or self._paused_at or time.monotonic()
+        return end - self.started - self._paused_time
+    
+    @property
+    def rate(self) -> float:
+        """Сообщений в секунду (только за этот запуск)"""
+        elapsed = self.elapsed
+        return (self.processed - self._resumed_from) / elapsed if elapsed > 0 else 0.0
+    
+    @property
+    def eta(self) -> Optional[float]:
+        """Оценка оставшегося времени в секундах"""
+        rate = self.rate
+        if rate <= 0:
+            return None
+        return max(self.total - self.processed, 0) / rate
+    
+    def pause(self):
+        if self.paused or self.cancelled:
+            return
+        self._paused_at = time.monotonic()
+        self._resumed.clear()
+    
+    def resume(self):
+        if not self.paused:
+            return
+        if self.started is not None:
+            self._paused_time += time.monotonic() - self._paused_at
+        self._paused_at = None
+        self._resumed.set()
+    
+    def cancel(self):
+        """Новые отправки не начинаются, уже начатые завершаются"""
+        self.cancelled = True
+        self.resume()
+    
+    async def _report_periodically(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            try:
+                await self.on_progress(self)
+            except Exception as e:
+                logger.warning(f"Error reporting delivery progress: {e}")
+    
+    async def _deliver(self, chat_id: int):
+        attempted = False
+        last_error = None
+        
+        async def gated_send(chat_id: int):
+            nonlocal attempted, last_error
+            await self._resumed.wait()
+            if self.cancelled:
+                raise DeliveryCancelled()
+            attempted = True
+            try:
+                return await self.send(chat_id)
+            except Exception as e:
+                last_error = e
+                raise
+        
+        error = None
+        try:
+            await send_with_retry(chat_id, gated_send, self.limiter, self.weight)
+        except DeliveryCancelled:
+            # Запрос уже уходил хотя бы раз: сообщение могло дойти, поэтому
+            # получатель считается неудачным, а не возвращается в очередь
+            if not attempted:
+                return
+            error = last_error
+        except Exception as e:
+            error = e
+        
+        if error is None:
+            self.successful += 1
+        else:
+            self.failed += 1
+            if len(self.failures) < DELIVERY_FAILURES_KEPT:
+                self.failures.append((chat_id, str(error)[:50]))
+            logger.error(f"Error sending to {chat_id}: {error}")
+        
+        if self.on_result:
+            self.on_result(chat_id, error)
+    
+    async def _produce(self, queue: asyncio.Queue):
+        if hasattr(self.chat_ids, '__aiter__'):
+            async for chat_id in self.chat_ids:
+                if self.cancelled:
+                    break
+                await queue.put(chat_id)
+        else:
+            for chat_id in self.chat_ids:
+                if self.cancelled:
+                    break
+                await queue.put(chat_id)
+        for _ in range(self.concurrency):
+            await queue.put(None)
+    
+    async def _work(self, queue: asyncio.Queue):
+        while (chat_id := await queue.get()) is not None:
+            await self._resumed.wait()
+            # После отмены просто разбираем очередь до конца
+            if not self.cancelled:
+                await self._deliver(chat_id)
+    
+    async def run(self) -> 'Delivery':
+        self.started = time.monotonic()
+        if self.paused:
+            self._paused_at = self.started
+        # Очередь ограничена: в памяти только ближайшие получатели
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        reporter = asyncio.create_task(self._report_periodically()) if self.on_progress else None
+        workers = [asyncio.create_task(self._work(queue)) for _ in range(self.concurrency)]
+        try:
+            try:
+                await self._produce(queue)
+            except Exception:
+                # Источник получателей упал (например, база занята): новые
+                # отправки не начинаем, начатые завершаем, воркеры выходят
+                self.cancel()
+                for _ in range(self.concurrency):
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+                raise
+            await asyncio.gather(*workers)
+        finally:
+            # При ошибке или отмене самой рассылки воркеры не должны остаться висеть
+            for worker in workers:
+                worker.cancel()
+            if reporter:
+                reporter.cancel()
+        self.finished = time.monotonic()
+        logger.info(
+            f"Delivery {'cancelled' if self.cancelled else 'finished'}: "
+            f"{self.successful}/{self.total} sent, {self.failed} failed "
+            f"in {self.elapsed:.1f}s ({self.rate:.1f} msg/s)"
+        )
+        return self
+
+# Категории ошибок отправки
+SEND_ERROR_UNREACHABLE = 'unreachable'  # бот заблокирован, аккаунт удален, чата нет
+SEND_ERROR_FLOOD = 'flood'
+SEND_ERROR_NETWORK = 'network'
+SEND_ERROR_OTHER = 'other'
+
+# BadRequest, после которых писать в этот чат бесполезно
+UNREACHABLE_BAD_REQUESTS = ('chat not found', 'user not found', 'peer_id_invalid')
+
+def classify_send_error(error: Exception) -> str:
+    if isinstance(error, Forbidden):
+        return SEND_ERROR_UNREACHABLE
+    if isinstance(error, BadRequest):
+        message = error.message.lower()
+        if any(reason in message for reason in UNREACHABLE_BAD_REQUESTS):
+            return SEND_ERROR_UNREACHABLE
+        return SEND_ERROR_OTHER
+    if isinstance(error, RetryAfter):
+        return SEND_ERROR_FLOOD
+    if isinstance(error, NetworkError):
+        return SEND_ERROR_NETWORK
+    return SEND_ERROR_OTHER
+
+# ===== ОЧЕРЕДЬ РАССЫЛОК (С ВОССТАНОВЛЕНИЕМ ПОСЛЕ ПЕРЕЗАПУСКА) =====
+class DeliveryJob:
+    """Рассылка, сохраненная в базе. Получатели берутся страницами и сразу
+    помечаются, результаты записываются пачками, поэтому после перезапуска
+    рассылка продолжается с места остановки и никому не приходит дважды."""
+    def __init__(self, row: sqlite3.Row):
+        self.job_id = row['job_id']
+        self.kind = row['kind']
+        self.message = json.loads(row['message'])
+        self.total = row['total']
+        self.status = row['status']
+        self.delivery: Optional[Delivery] = None
+        self.progress_chat_id = row['progress_chat_id']
+        self.progress_message_id = row['progress_message_id']
+        self.lease = f"delivery_job:{self.job_id}"
+        # Аренду перехватил другой процесс: останавливаемся, не завершая рассылку
+        self.lost_lease = False
+        # Бот выключается: останавливаемся и отдаем рассылку следующему запуску
+        self.stopping = False
+        self._cursor = -2 ** 63
+        self._outcomes: List[tuple] = []
+        self._progress_text: Optional[str] = None
+    
+    async def recipients(self):
+        while True:
+            await self.flush()
+            chat_ids = await storage.run(
+                DB_FILE, _claim_recipients, self.job_id, self.lease, WORKER_ID,
+                self._cursor, DELIVERY_CLAIM_BATCH
+            )
+            if chat_ids is None:
+                logger.error(f"Lost lease on delivery job {self.job_id}, stopping")
+                self.lost_lease = True
+                self.delivery.cancel()
+                return
+            if not chat_ids:
+                return
+            self._cursor = chat_ids[-1]
+            for chat_id in chat_ids:
+                yield chat_id
+    
+    def record(self, chat_id: int, error: Optional[Exception]):
+        if error is None:
+            status = RECIPIENT_SENT
+        elif classify_send_error(error) == SEND_ERROR_UNREACHABLE:
+            status = RECIPIENT_UNREACHABLE
+        else:
+            status = RECIPIENT_FAILED
+        self._outcomes.append((chat_id, status))
+    
+    async def flush(self):
+        if not self._outcomes:
+            return
+        outcomes, self._outcomes = self._outcomes, []
+        await storage.run(DB_FILE, _record_recipient_statuses, self.job_id, outcomes)
+    
+    async def edit_progress(self, bot, text: str):
+        # Telegram отвечает ошибкой на правку без изменений, да и запрос лишний
+        if text == self._progress_text:
+            return
+        await bot.edit_message_text(
+            chat_id=self.progress_chat_id, message_id=self.progress_message_id, text=text
+        )
+        self._progress_text = text
+    
+    def apply_status(self, status: str):
+        """Приводит рассылку к статусу из базы: паузу и отмену
+        могли запросить через любой процесс бота"""
+        self.status = status
+        if status == 'cancelling':
+            # Статус cancelled запишется, когда воркеры остановятся
+            self.delivery.cancel()
+        elif status == 'paused':
+            self.delivery.pause()
+        elif status == 'running':
+            self.delivery.resume()
+    
+    def stop(self):
+        self.stopping = True
+        self.delivery.cancel()
+    
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(DELIVERY_HEARTBEAT_INTERVAL)
+            delivery = self.delivery
+            try:
+                owned, status = await storage.run(
+                    DB_FILE, _delivery_heartbeat, self.job_id, self.lease, WORKER_ID, LEASE_TTL,
+                    delivery.successful, delivery.failed, delivery.rate
+                )
+            except Exception as e:
+                logger.warning(f"Heartbeat failed for delivery job {self.job_id}: {e}")
+                continue
+            
+            if not owned:
+                logger.error(f"Lost lease on delivery job {self.job_id}, stopping")
+                self.lost_lease = True
+                delivery.cancel()
+                return
+            if status != self.status:
+                self.apply_status(status)
+
+def format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "—"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours} ч {minutes} мин"
+    if minutes:
+        return f"{minutes} мин {seconds} с"
+    return f"{seconds} с"
+
+def format_delivery_speed(delivery: Delivery) -> str:
+    # Скорость округляем, чтобы текст не менялся от каждой доли секунды
+    if delivery.paused:
+        return "⏸ На паузе"
+    return f"⚡ {delivery.rate:.0f} сообщ./с, осталось ~{format_duration(delivery.eta)}"
+
+def format_delivery_progress(job: DeliveryJob, delivery: Delivery) -> str:
+    if job.kind == 'quick':
+        return (
+            f"🔄 {delivery.processed}/{delivery.total}... ✅ {delivery.successful}\n"
+            f"{format_delivery_speed(delivery)}"
+        )
+    
+    title = "🔄 Рассылка..." if job.kind == 'channels' else "🔄 Рассылка пользователям..."
+    return (
+        f"{title}\n\n"
+        f"✅ Успешно: {delivery.successful}\n"
+        f"❌ Ошибок: {delivery.failed}\n"
+        f"📊 Прогресс: {delivery.processed}/{delivery.total}\n"
+        f"{format_delivery_speed(delivery)}"
+    )
+
+async def format_delivery_report(job: DeliveryJob, delivery: Delivery, unreachable_count: int) -> str:
+    report = "⛔ Рассылка отменена администратором\n\n" if delivery.cancelled else ""
+    return report + await _format_delivery_totals(job, delivery, unreachable_count)
+
+async def _format_delivery_totals(job: DeliveryJob, delivery: Delivery, unreachable_count: int) -> str:
+    total = delivery.total
+    successful = delivery.successful
+    failed = delivery.failed
+    speed = f"⚡ Скорость: {delivery.rate:.1f} сообщ./с за {delivery.elapsed:.0f} с"
+    
+    if job.kind == 'quick':
+        final_text = f"✅ **Быстрая рассылка завершена!**\n\n"
+        final_text += f"👥 Всего пользователей: {total}\n"
+        final_text += f"✅ Успешно отправлено: {successful}\n"
+        final_text += f"❌ Ошибок: {failed}\n"
+        final_text += f"🚫 Недоступны (отключены от рассылок): {unreachable_count}\n"
+        final_text += speed
+        return final_text
+    
+    if job.kind == 'users':
+        report = f"📊 **Рассылка пользователям завершена!**\n\n"
+        report += f"👥 Всего пользователей: {total}\n"
+        report += f"✅ Успешно отправлено: {successful}\n"
+        report += f"❌ Не отправлено: {failed}\n"
+        report += f"🚫 Недоступны (отключены от рассылок): {unreachable_count}\n"
+        
+        if total > 0:
+            report += f"📈 Эффективность: {(successful/total*100):.1f}%\n"
+        report += speed + "\n"
+        return report
+    
+    channels = await load_broadcast_channels()
+    failed_channels = [
+        f"{channels.get(str(chat_id), {}).get('title', chat_id)} ({error})"
+        for chat_id, error in delivery.failures
+    ]
+    
+    report = f"📊 **Рассылка завершена!**\n\n"
+    report += f"✅ Успешно отправлено: {successful}\n"
+    report += f"❌ Не отправлено: {failed}\n"
+    
+    if total > 0:
+        report += f"📈 Эффективность: {(successful/total*100):.1f}%\n"
+    report += speed + "\n"
+    
+    if failed_channels:
+        report += f"\n❌ Проблемные каналы:\n"
+        for failed_channel in failed_channels:
+            report += f"• {failed_channel}\n"
+        if failed > len(failed_channels):
+            report += f"и еще {failed - len(failed_channels)}...\n"
+    
+    return report
+
+async def run_delivery_job(bot, job_id: int):
+    """Выполняет (или продолжает) сохраненную рассылку. Вызывается
+    только владельцем аренды рассылки."""
+    row = await storage.run(DB_FILE, _select_delivery_job, job_id)
+    # Рассылку мог только что завершить другой процесс
+    if row is None or row['status'] not in ('running', 'paused', 'cancelling'):
+        return
+    job = DeliveryJob(row)
+    
+    # Взятые, но не подтвержденные прошлым запуском получатели считаются
+    # неотправленными: повторять их нельзя, иначе возможен дубль
+    counts = await storage.run(DB_FILE, _count_recipient_statuses, job_id)
+    successful = counts.get(RECIPIENT_SENT, 0)
+    failed = sum(counts.get(status, 0) for status in
+                 (RECIPIENT_CLAIMED, RECIPIENT_FAILED, RECIPIENT_UNREACHABLE))
+    if successful or failed:
+        logger.info(f"Resuming delivery job {job_id}: {successful + failed}/{job.total} already processed")
+    
+    async def report_progress(delivery: Delivery):
+        await job.edit_progress(bot, format_delivery_progress(job, delivery))
+    
+    job.delivery = Delivery(
+        job.recipients(),
+        make_sender(bot, job.message),
+        on_progress=report_progress,
+        total=job.total,
+        on_result=job.record,
+        successful=successful,
+        failed=failed,
+        weight=message_weight(job.message)
+    )
+    job.apply_status(job.status)
+    
+    if _deliveries_stopping:
+        return
+    active_jobs[job_id] = job
+    heartbeat = asyncio.create_task(job.heartbeat())
+    try:
+        try:
+            delivery = await job.delivery.run()
+        except asyncio.CancelledError:
+            await job.flush()
+            raise
+        except Exception:
+            # Источник получателей упал (например, база занята). Начатые
+            # отправки завершены, после их записи остальные взятые не получали
+            # сообщения: возвращаем их, рассылка продолжится при следующей попытке
+            await job.flush()
+            released = await storage.run(DB_FILE, _release_claimed_recipients, job_id, job.lease, WORKER_ID)
+            logger.warning(f"Delivery job {job_id} interrupted, {released} recipients returned to queue")
+            raise
+        await job.flush()
+    finally:
+        heartbeat.cancel()
+        active_jobs.pop(job_id, None)
+    
+    if job.lost_lease:
+        return
+    if job.stopping:
+        # Все начатые отправки завершились и записаны, так что оставшиеся
+        # взятые получатели не получали сообщения - их можно повторить
+        released = await storage.run(DB_FILE, _release_claimed_recipients, job_id, job.lease, WORKER_ID)
+        logger.info(f"Delivery job {job_id} stopped for shutdown, {released} recipients returned to queue")
+        return
+    
+    unreachable_users = []
+    if job.kind != 'channels':
+        # Отключаем заблокировавших бота и удаленные аккаунты
+        unreachable_users = await storage.run(
+            DB_FILE, _select_recipients_with_status, job_id, RECIPIENT_UNREACHABLE
+        )
+        if unreachable_users:
+            await deactivate_users(unreachable_users)
+    
+    await storage.run(
+        DB_FILE, _finish_delivery_job, job_id, 'cancelled' if delivery.cancelled else 'done',
+        delivery.successful, delivery.failed
+    )
+    
+    try:
+        await job.edit_progress(bot, await format_delivery_report(job, delivery, len(unreachable_users)))
+    except Exception as e:
+        logger.warning(f"Error sending report for delivery job {job_id}: {e}")
+
+# Выполняющиеся сейчас рассылки (для управления из админки)
+active_jobs: Dict[int, DeliveryJob] = {}
+delivery_tasks: Dict[int, asyncio.Task] = {}
+_deliveries_stopping = False
+
+def spawn_delivery_job(bot, job_id: int) -> asyncio.Task:
+    async def runner():
+        lease = f"delivery_job:{job_id}"
+        try:
+            if not await storage.run(DB_FILE, _acquire_lease, lease, WORKER_ID, LEASE_TTL):
+                # Рассылку ведет другой процесс бота
+                return
+            try:
+                await run_delivery_job(bot, job_id)
+            finally:
+                await storage.run(DB_FILE, _release_lease, lease, WORKER_ID)
+        except Exception as e:
+            # Задача остается в статусе running и продолжится при следующем запуске
+            logger.error(f"Delivery job {job_id} failed: {e}")
+        finally:
+            delivery_tasks.pop(job_id, None)
+    
+    task = asyncio.create_task(runner())
+    delivery_tasks[job_id] = task
+    return task
+
+async def start_delivery_job(bot, kind: str, message: Dict, chat_ids: Optional[List[int]], progress_msg,
+                             segment: str = 'all') -> int:
+    """Сохраняет рассылку в базе и запускает ее в фоне.
+    chat_ids=None - рассылка активным пользователям сегмента."""
+    job_id = await storage.run(
+        DB_FILE, _create_delivery_job, kind, json.dumps(message, ensure_ascii=False), chat_ids,
+        progress_msg.chat_id, progress_msg.message_id, segment
+    )
+    spawn_delivery_job(bot, job_id)
+    return job_id
+
+async def resume_delivery_jobs(bot) -> int:
+    """Подхватывает незавершенные рассылки без владельца: прерванные
+    остановкой бота или падением другого процесса (поставленные на паузу
+    остаются на паузе)"""
+    rows = await storage.run(DB_FILE, _select_unfinished_delivery_jobs)
+    spawned = 0
+    for row in rows:
+        if row['job_id'] not in delivery_tasks:
+            spawn_delivery_job(bot, row['job_id'])
+            spawned += 1
+    return spawned
+
+async def stop_delivery_jobs(timeout: float = DELIVERY_STOP_TIMEOUT):
+    """Останавливает рассылки этого процесса при выключении бота: начатые
+    отправки завершаются и записываются, взятые, но не отправленные
+    получатели возвращаются в очередь, аренда освобождается. Следующий
+    запуск или другой процесс продолжит рассылку, не дожидаясь LEASE_TTL."""
+    global _deliveries_stopping
+    _deliveries_stopping = True
+    for job in list(active_jobs.values()):
+        job.stop()
+    
+    tasks = list(delivery_tasks.values())
+    if not tasks:
+        return
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    if pending:
+        # Не уложились: прерываем, недоотправленные останутся взятыми
+        logger.warning(f"{len(pending)} delivery jobs did not stop in {timeout}s, cancelling")
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+async def resume_delivery_jobs_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически забирает рассылки, чей владелец перестал продлевать аренду"""
+    await resume_delivery_jobs(context.bot)
+
+# Действие из админки -> статус рассылки в базе
+JOB_ACTION_STATUSES = {'pause': 'paused', 'resume': 'running', 'cancel': 'cancelling'}
+
+async def control_delivery_job(job_id: int, action: str) -> bool:
+    """Пауза, продолжение или отмена рассылки из любого процесса бота.
+    Владелец в этом процессе применяет команду сразу, в другом -
+    при следующем продлении аренды. False - рассылка уже завершена."""
+    status = JOB_ACTION_STATUSES[action]
+    if not await storage.run(DB_FILE, _set_delivery_job_status, job_id, status):
+        return False
+    job = active_jobs.get(job_id)
+    if job is not None:
+        job.apply_status(status)
+    return True
 
 # ===== РАССЫЛКА ПО КАНАЛАМ (ПОЛНАЯ ВЕРСИЯ) =====
 async def broadcast_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -555,7 +2205,7 @@ async def broadcast_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Нет прав доступа.")
         return
     
-    accessible_channels = await get_accessible_channels(context)
+    accessible_channels = await get_cached_accessible_channels()
     channels_count = len(accessible_channels)
     
     text = f"📢 **Панель управления рассылкой**\n\n"
@@ -583,7 +2233,7 @@ async def broadcast_panel_callback(update: Update, context: ContextTypes.DEFAULT
     if not is_admin(query.from_user.id):
         return
     
-    accessible_channels = await get_accessible_channels(context)
+    accessible_channels = await get_cached_accessible_channels()
     channels_count = len(accessible_channels)
     
     text = f"📢 **Панель управления рассылкой**\n\n"
@@ -611,7 +2261,7 @@ async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(query.from_user.id):
         return
     
-    accessible_channels = await get_accessible_channels(context)
+    accessible_channels = await get_cached_accessible_channels()
     
     if not accessible_channels:
         await query.message.edit_text("❌ Нет доступных каналов для рассылки!")
@@ -633,37 +2283,14 @@ async def handle_broadcast_content(update: Update, context: ContextTypes.DEFAULT
     if not is_admin(update.effective_user.id):
         return
     
-    context.user_data['broadcast_message'] = {
-        'message_id': update.message.message_id,
-        'chat_id': update.effective_chat.id
-    }
+    if add_album_part(context.user_data.get('broadcast_message'), update.message):
+        return BROADCAST_CONFIRM
     
-    if update.message.text:
-        context.user_data['broadcast_message']['type'] = 'text'
-        context.user_data['broadcast_message']['content'] = update.message.text
-        context.user_data['broadcast_message']['entities'] = update.message.entities
-    
-    elif update.message.photo:
-        context.user_data['broadcast_message']['type'] = 'photo'
-        context.user_data['broadcast_message']['photo'] = update.message.photo[-1].file_id
-        context.user_data['broadcast_message']['caption'] = update.message.caption
-        context.user_data['broadcast_message']['caption_entities'] = update.message.caption_entities
-    
-    elif update.message.video:
-        context.user_data['broadcast_message']['type'] = 'video'
-        context.user_data['broadcast_message']['video'] = update.message.video.file_id
-        context.user_data['broadcast_message']['caption'] = update.message.caption
-        context.user_data['broadcast_message']['caption_entities'] = update.message.caption_entities
-    
-    elif update.message.document:
-        context.user_data['broadcast_message']['type'] = 'document'
-        context.user_data['broadcast_message']['document'] = update.message.document.file_id
-        context.user_data['broadcast_message']['caption'] = update.message.caption
-        context.user_data['broadcast_message']['caption_entities'] = update.message.caption_entities
-    
-    else:
+    broadcast_message = capture_message(update.message)
+    if broadcast_message is None:
         await update.message.reply_text("❌ Неподдерживаемый тип сообщения!")
         return ConversationHandler.END
+    context.user_data['broadcast_message'] = broadcast_message
     
     channels = context.user_data.get('broadcast_channels', {})
     channels_count = len(channels)
@@ -709,10 +2336,9 @@ async def execute_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     progress_msg = await query.message.edit_text(f"🔄 Начинаем рассылку...\n\n0/{total_channels}")
     
     # Запускаем рассылку в фоне
-    asyncio.create_task(
-        execute_broadcast_background(
-            context, channels, broadcast_message, progress_msg, query.message
-        )
+    await start_delivery_job(
+        context.bot, 'channels', broadcast_message,
+        [int(chat_id_str) for chat_id_str in channels], progress_msg
     )
     
     await query.message.reply_text(
@@ -729,86 +2355,6 @@ async def execute_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return ConversationHandler.END
 
-async def execute_broadcast_background(context, channels: Dict, broadcast_message: Dict, 
-                                     progress_msg, query_message):
-    """Фоновая задача рассылки"""
-    successful = 0
-    failed = 0
-    failed_channels = []
-    total = len(channels)
-    
-    for i, (chat_id_str, channel_info) in enumerate(channels.items(), 1):
-        try:
-            chat_id = int(chat_id_str)
-            
-            if broadcast_message['type'] == 'text':
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=broadcast_message['content'],
-                    entities=broadcast_message.get('entities')
-                )
-            elif broadcast_message['type'] == 'photo':
-                await context.bot.send_photo(
-                    chat_id=chat_id,
-                    photo=broadcast_message['photo'],
-                    caption=broadcast_message.get('caption'),
-                    caption_entities=broadcast_message.get('caption_entities')
-                )
-            elif broadcast_message['type'] == 'video':
-                await context.bot.send_video(
-                    chat_id=chat_id,
-                    video=broadcast_message['video'],
-                    caption=broadcast_message.get('caption'),
-                    caption_entities=broadcast_message.get('caption_entities')
-                )
-            elif broadcast_message['type'] == 'document':
-                await context.bot.send_document(
-                    chat_id=chat_id,
-                    document=broadcast_message['document'],
-                    caption=broadcast_message.get('caption'),
-                    caption_entities=broadcast_message.get('caption_entities')
-                )
-            
-            successful += 1
-            
-        except Exception as e:
-            failed += 1
-            failed_channels.append(f"{channel_info['title']} ({str(e)[:50]})")
-            logger.error(f"Error sending to {chat_id_str}: {e}")
-        
-        # Обновляем прогресс
-        if i % 5 == 0 or i == total:
-            try:
-                await progress_msg.edit_text(
-                    f"🔄 Рассылка...\n\n"
-                    f"✅ Успешно: {successful}\n"
-                    f"❌ Ошибок: {failed}\n"
-                    f"📊 Прогресс: {i}/{total}"
-                )
-            except:
-                pass
-        
-        await asyncio.sleep(0.5)
-    
-    report = f"📊 **Рассылка завершена!**\n\n"
-    report += f"✅ Успешно отправлено: {successful}\n"
-    report += f"❌ Не отправлено: {failed}\n"
-    
-    if total > 0:
-        report += f"📈 Эффективность: {(successful/total*100):.1f}%\n"
-    
-    if failed_channels:
-        report += f"\n❌ Проблемные каналы:\n"
-        for failed_channel in failed_channels[:10]:
-            report += f"• {failed_channel}\n"
-        if len(failed_channels) > 10:
-            report += f"и еще {len(failed_channels) - 10}...\n"
-    
-    try:
-        await progress_msg.edit_text(report)
-    except:
-        pass
-
 async def broadcast_list_channels(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать список каналов для рассылки (полная)"""
     query = update.callback_query
@@ -817,8 +2363,8 @@ async def broadcast_list_channels(update: Update, context: ContextTypes.DEFAULT_
     if not is_admin(query.from_user.id):
         return
     
-    accessible_channels = await get_accessible_channels(context)
-    all_channels = load_broadcast_channels()
+    accessible_channels = await get_cached_accessible_channels()
+    all_channels = await load_broadcast_channels()
     
     text = "📋 **Список каналов для рассылки**\n\n"
     
@@ -853,8 +2399,11 @@ async def broadcast_check_access(update: Update, context: ContextTypes.DEFAULT_T
     
     progress_msg = await query.message.edit_text("🔄 Проверяем доступ к каналам...")
     
-    accessible_channels = await get_accessible_channels(context)
-    all_channels = load_broadcast_channels()
+    async def report_progress(done: int, total: int):
+        await progress_msg.edit_text(f"🔄 Проверяем доступ к каналам...\n\n📊 Проверено: {done}/{total}")
+    
+    accessible_channels = await get_accessible_channels(context, on_progress=report_progress)
+    all_channels = await load_broadcast_channels()
     
     await progress_msg.edit_text(
         f"🔍 **Проверка доступа завершена**\n\n"
@@ -872,19 +2421,15 @@ async def broadcast_clean_inactive(update: Update, context: ContextTypes.DEFAULT
     if not is_admin(query.from_user.id):
         return
     
-    accessible_channels = await get_accessible_channels(context)
-    
-    with open(BROADCAST_CHANNELS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(accessible_channels, f, ensure_ascii=False, indent=2)
-    
-    cache.set_broadcast(accessible_channels)
-    
-    all_channels = load_broadcast_channels()
-    removed_count = len(all_channels) - len(accessible_channels)
+    result = await remove_inaccessible_channels()
+    if result is None:
+        await query.message.edit_text("❌ Не удалось очистить каналы, попробуйте еще раз.")
+        return
     
+    kept_count, removed_count = result
     await query.message.edit_text(
         f"🧹 **Очистка завершена**\n\n"
-        f"✅ Активных сохранено: {len(accessible_channels)}\n"
+        f"✅ Активных сохранено: {kept_count}\n"
         f"🗑 Удалено неактивных: {removed_count}"
     )
 
@@ -908,7 +2453,7 @@ async def notify_users_command(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("❌ Нет прав доступа.")
         return
     
-    user_count = get_user_count()
+    user_count = user_stats.total
     
     text = f"👥 **Рассылка пользователям**\n\n"
     text += f"📊 Всего пользователей: {user_count}\n\n"
@@ -931,14 +2476,31 @@ async def notify_users_callback(update: Update, context: ContextTypes.DEFAULT_TY
         return
     
     if query.data == "notify_users_start":
-        user_count = get_user_count()
+        keyboard = []
+        for segment, (title, _, _) in AUDIENCE_SEGMENTS.items():
+            count = await get_audience_count(segment)
+            keyboard.append([InlineKeyboardButton(f"{title} ({count})", callback_data=f"notify_segment_{segment}")])
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="notify_back")])
+        
+        await query.message.edit_text(
+            "🎯 **Кому отправить рассылку?**",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    
+    elif query.data.startswith("notify_segment_"):
+        segment = query.data[len("notify_segment_"):]
+        if segment not in AUDIENCE_SEGMENTS:
+            return ConversationHandler.END
+        
+        user_count = await get_audience_count(segment)
         
         if user_count == 0:
             await query.message.edit_text("❌ Нет пользователей для рассылки!")
-            return
+            return ConversationHandler.END
         
         await query.message.edit_text(
             f"📝 **Начинаем рассылку пользователям!**\n\n"
+            f"🎯 Аудитория: {AUDIENCE_SEGMENTS[segment][0]}\n"
             f"👥 Получателей: {user_count} пользователей\n\n"
             f"Отправьте сообщение для рассылки (текст, фото, видео или документ).\n"
             f"Поддерживаются все типы сообщений.\n\n"
@@ -946,47 +2508,25 @@ async def notify_users_callback(update: Update, context: ContextTypes.DEFAULT_TY
         )
         
         context.user_data['notify_mode'] = True
+        context.user_data['notify_segment'] = segment
         return NOTIFY_WAITING
     
     elif query.data == "notify_stats":
-        users = load_users()
-        total_users = len(users)
-        
-        active_last_week = 0
-        active_last_month = 0
-        
-        for user_data in users.values():
-            last_seen_str = user_data.get('last_seen')
-            if last_seen_str:
-                try:
-                    last_seen = datetime.fromisoformat(last_seen_str)
-                    days_ago = (datetime.now() - last_seen).days
-                    
-                    if days_ago <= 7:
-                        active_last_week += 1
-                    if days_ago <= 30:
-                        active_last_month += 1
-                except:
-                    pass
+        total_users = user_stats.total
+        active_last_week = user_stats.seen_within(7)
+        active_last_month = user_stats.seen_within(30)
         
         text = f"📊 **Статистика пользователей**\n\n"
         text += f"👥 Всего пользователей: {total_users}\n"
         text += f"📈 Активных за неделю: {active_last_week}\n"
         text += f"📈 Активных за месяц: {active_last_month}\n"
-        text += f"📉 Неактивных: {total_users - active_last_month}\n\n"
+        text += f"📉 Неактивных: {total_users - active_last_month}\n"
+        text += f"🚫 Недоступны для рассылки: {user_stats.unreachable}\n\n"
         
         if total_users > 0:
             text += "🆕 Последние пользователи:\n"
             
-            sorted_users = sorted(
-                users.items(),
-                key=lambda x: x[1].get('joined_date', ''),
-                reverse=True
-            )[:5]
-            
-            for user_id_str, user_data in sorted_users:
-                username = user_data.get('username', 'нет юзернейма')
-                first_name = user_data.get('first_name', '')
+            for _, username, first_name in user_stats.recent:
                 text += f"• @{username} ({first_name})\n"
         else:
             text += "📭 Пользователей еще нет"
@@ -1007,7 +2547,7 @@ async def notify_users_callback(update: Update, context: ContextTypes.DEFAULT_TY
 
 async def notify_users_command_from_callback(query):
     """Вспомогательная функция для вызова из callback"""
-    user_count = get_user_count()
+    user_count = user_stats.total
     
     text = f"👥 **Рассылка пользователям**\n\n"
     text += f"📊 Всего пользователей: {user_count}\n\n"
@@ -1029,40 +2569,17 @@ async def handle_notify_content(update: Update, context: ContextTypes.DEFAULT_TY
     if not context.user_data.get('notify_mode'):
         return
     
-    context.user_data['notify_message'] = {
-        'message_id': update.message.message_id,
-        'chat_id': update.effective_chat.id
-    }
-    
-    if update.message.text:
-        context.user_data['notify_message']['type'] = 'text'
-        context.user_data['notify_message']['content'] = update.message.text
-        context.user_data['notify_message']['entities'] = update.message.entities
-    
-    elif update.message.photo:
-        context.user_data['notify_message']['type'] = 'photo'
-        context.user_data['notify_message']['photo'] = update.message.photo[-1].file_id
-        context.user_data['notify_message']['caption'] = update.message.caption
-        context.user_data['notify_message']['caption_entities'] = update.message.caption_entities
-    
-    elif update.message.video:
-        context.user_data['notify_message']['type'] = 'video'
-        context.user_data['notify_message']['video'] = update.message.video.file_id
-        context.user_data['notify_message']['caption'] = update.message.caption
-        context.user_data['notify_message']['caption_entities'] = update.message.caption_entities
-    
-    elif update.message.document:
-        context.user_data['notify_message']['type'] = 'document'
-        context.user_data['notify_message']['document'] = update.message.document.file_id
-        context.user_data['notify_message']['caption'] = update.message.caption
-        context.user_data['notify_message']['caption_entities'] = update.message.caption_entities
+    if add_album_part(context.user_data.get('notify_message'), update.message):
+        return NOTIFY_CONFIRM
     
-    else:
+    notify_message = capture_message(update.message)
+    if notify_message is None:
         await update.message.reply_text("❌ Неподдерживаемый тип сообщения!")
         context.user_data.pop('notify_mode', None)
         return ConversationHandler.END
+    context.user_data['notify_message'] = notify_message
     
-    user_count = get_user_count()
+    user_count = await get_audience_count(context.user_data.get('notify_segment', 'all'))
     
     keyboard = [
         [InlineKeyboardButton("✅ Начать рассылку", callback_data="notify_confirm")],
@@ -1091,33 +2608,29 @@ async def execute_notify_users(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.message.edit_text("❌ Рассылка отменена.")
         context.user_data.pop('notify_mode', None)
         context.user_data.pop('notify_message', None)
+        context.user_data.pop('notify_segment', None)
         return ConversationHandler.END
     
     if query.data != "notify_confirm":
         return ConversationHandler.END
     
     notify_message = context.user_data.get('notify_message')
-    users = load_users()
+    segment = context.user_data.get('notify_segment', 'all')
+    total_users = await get_audience_count(segment)
     
-    if not notify_message or not users:
+    if not notify_message or not total_users:
         await query.message.edit_text("❌ Ошибка: данные рассылки не найдены!")
         context.user_data.pop('notify_mode', None)
         return ConversationHandler.END
     
-    user_ids = list(users.keys())
-    total_users = len(user_ids)
-    
     progress_msg = await query.message.edit_text(f"🔄 Начинаем рассылку пользователям...\n\n0/{total_users}")
     
     # Запускаем в фоне
-    asyncio.create_task(
-        execute_notify_users_background(
-            context, user_ids, notify_message, progress_msg, query.message
-        )
-    )
+    await start_delivery_job(context.bot, 'users', notify_message, None, progress_msg, segment)
     
     await query.message.reply_text(
         f"✅ **Рассылка запущена в фоне!**\n\n"
+        f"🎯 Аудитория: {AUDIENCE_SEGMENTS[segment][0]}\n"
         f"👥 Пользователей: {total_users}\n"
         f"📝 Тип: {notify_message['type']}\n\n"
         f"Прогресс выше. Бот продолжает работать!"
@@ -1125,117 +2638,10 @@ async def execute_notify_users(update: Update, context: ContextTypes.DEFAULT_TYP
     
     context.user_data.pop('notify_mode', None)
     context.user_data.pop('notify_message', None)
+    context.user_data.pop('notify_segment', None)
     
     return ConversationHandler.END
 
-async def execute_notify_users_background(context, user_ids: List[str], notify_message: Dict, 
-                                        progress_msg, query_message):
-    """Фоновая задача рассылки пользователям"""
-    successful = 0
-    failed = 0
-    blocked_users = set()
-    total = len(user_ids)
-    
-    # Оптимизация: группируем по 20 пользователей
-    batch_size = 20
-    
-    for i in range(0, total, batch_size):
-        batch = user_ids[i:i + batch_size]
-        tasks = []
-        
-        for user_id_str in batch:
-            try:
-                user_id = int(user_id_str)
-                
-                if notify_message['type'] == 'text':
-                    task = context.bot.send_message(
-                        chat_id=user_id,
-                        text=notify_message['content'],
-                        entities=notify_message.get('entities')
-                    )
-                elif notify_message['type'] == 'photo':
-                    task = context.bot.send_photo(
-                        chat_id=user_id,
-                        photo=notify_message['photo'],
-                        caption=notify_message.get('caption'),
-                        caption_entities=notify_message.get('caption_entities')
-                    )
-                elif notify_message['type'] == 'video':
-                    task = context.bot.send_video(
-                        chat_id=user_id,
-                        video=notify_message['video'],
-                        caption=notify_message.get('caption'),
-                        caption_entities=notify_message.get('caption_entities')
-                    )
-                elif notify_message['type'] == 'document':
-                    task = context.bot.send_document(
-                        chat_id=user_id,
-                        document=notify_message['document'],
-                        caption=notify_message.get('caption'),
-                        caption_entities=notify_message.get('caption_entities')
-                    )
-                else:
-                    continue
-                
-                tasks.append(task)
-                
-            except Exception:
-                failed += 1
-        
-        # Параллельная отправка
-        if tasks:
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            for result in results:
-                if isinstance(result, Exception):
-                    error_str = str(result).lower()
-                    if "blocked" in error_str or "bot was blocked" in error_str:
-                        blocked_users.add(user_id_str)
-                    failed += 1
-                else:
-                    successful += 1
-        
-        # Обновляем прогресс
-        current = min(i + batch_size, total)
-        if i % (batch_size * 5) == 0 or i + batch_size >= total:
-            try:
-                await progress_msg.edit_text(
-                    f"🔄 Рассылка пользователям...\n\n"
-                    f"✅ Успешно: {successful}\n"
-                    f"❌ Ошибок: {failed}\n"
-                    f"📊 Прогресс: {current}/{total}"
-                )
-            except:
-                pass
-        
-        await asyncio.sleep(0.05)
-    
-    # Удаляем заблокировавших
-    if blocked_users:
-        try:
-            users = load_users()
-            for user_id in blocked_users:
-                users.pop(user_id, None)
-            
-            with open(USERS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(users, f, ensure_ascii=False, indent=2)
-            cache.set_users(users)
-        except Exception as e:
-            logger.error(f"Error cleaning blocked users: {e}")
-    
-    report = f"📊 **Рассылка пользователям завершена!**\n\n"
-    report += f"👥 Всего пользователей: {total}\n"
-    report += f"✅ Успешно отправлено: {successful}\n"
-    report += f"❌ Не отправлено: {failed}\n"
-    report += f"🚫 Удалено заблокировавших: {len(blocked_users)}\n"
-    
-    if total > 0:
-        report += f"📈 Эффективность: {(successful/total*100):.1f}%\n"
-    
-    try:
-        await progress_msg.edit_text(report)
-    except:
-        pass
-
 # ===== БЫСТРАЯ РАССЫЛКА ТЕКСТОМ (ОПТИМИЗИРОВАННАЯ) =====
 async def quick_notify_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Быстрая рассылка текстом всем пользователям"""
@@ -1251,8 +2657,7 @@ async def quick_notify_command(update: Update, context: ContextTypes.DEFAULT_TYP
         return
     
     text = " ".join(context.args)
-    user_ids = list(load_users().keys())
-    total_users = len(user_ids)
+    total_users = await get_user_count(active_only=True)
     
     if total_users == 0:
         await update.message.reply_text("❌ Нет пользователей для рассылки!")
@@ -1261,9 +2666,8 @@ async def quick_notify_command(update: Update, context: ContextTypes.DEFAULT_TYP
     status_msg = await update.message.reply_text(f"🔄 Рассылка {total_users} пользователям...")
     
     # Запускаем в фоне
-    asyncio.create_task(
-        quick_notify_background(context, user_ids, text, status_msg, total_users)
-    )
+    message = {'type': 'text', 'content': text, 'disable_web_page_preview': True}
+    await start_delivery_job(context.bot, 'quick', message, None, status_msg)
     
     await update.message.reply_text(
         f"✅ **Быстрая рассылка запущена!**\n\n"
@@ -1272,74 +2676,90 @@ async def quick_notify_command(update: Update, context: ContextTypes.DEFAULT_TYP
         f"Прогресс выше. Бот работает!"
     )
 
-async def quick_notify_background(context, user_ids: List[str], text: str, 
-                                status_msg, total_users: int):
-    """Фоновая задача быстрой рассылки"""
-    successful = 0
-    failed = 0
-    blocked_users = set()
-    
-    batch_size = 25  # Больше батч для скорости
-    
-    for i in range(0, total_users, batch_size):
-        batch = user_ids[i:i + batch_size]
-        tasks = []
-        
-        for user_id_str in batch:
-            try:
-                task = context.bot.send_message(
-                    chat_id=int(user_id_str),
-                    text=text,
-                    disable_web_page_preview=True
-                )
-                tasks.append(task)
-            except:
-                failed += 1
-        
-        if tasks:
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            for result in results:
-                if isinstance(result, Exception):
-                    error_str = str(result).lower()
-                    if "blocked" in error_str or "bot was blocked" in error_str:
-                        blocked_users.add(user_id_str)
-                    failed += 1
-                else:
-                    successful += 1
+# ===== УПРАВЛЕНИЕ РАССЫЛКАМИ =====
+JOB_KIND_TITLES = {'channels': "📢 Каналы", 'users': "👥 Пользователи", 'quick': "⚡ Быстрая"}
+
+JOB_STATUS_TITLES = {'running': "▶️ идет", 'paused': "⏸ на паузе", 'cancelling': "⛔ отменяется"}
+
+async def build_jobs_panel():
+    """Текст и кнопки со списком незавершенных рассылок всех процессов бота.
+    Рассылки этого процесса показываются вживую, остальные - по прогрессу,
+    сохраненному владельцем."""
+    rows = await storage.run(DB_FILE, _select_unfinished_delivery_jobs)
+    if not rows:
+        keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin")]]
+        return "📦 Нет активных рассылок.", InlineKeyboardMarkup(keyboard)
+    
+    text = "📦 **Активные рассылки**\n"
+    keyboard = []
+    for row in rows:
+        job_id = row['job_id']
+        status = row['status']
+        job = active_jobs.get(job_id)
+        if job is not None:
+            successful, failed, rate = job.delivery.successful, job.delivery.failed, job.delivery.rate
+        else:
+            successful, failed, rate = row['sent'], row['failed'], row['rate']
+        processed = successful + failed
+        eta = max(row['total'] - processed, 0) / rate if rate > 0 else None
         
-        # Обновляем прогресс
-        current = min(i + batch_size, total_users)
-        if i % (batch_size * 4) == 0 or i + batch_size >= total_users:
-            try:
-                await status_msg.edit_text(f"🔄 {current}/{total_users}... ✅ {successful}")
-            except:
-                pass
+        text += (
+            f"\n#{job_id} {JOB_KIND_TITLES.get(row['kind'], row['kind'])} — {JOB_STATUS_TITLES[status]}\n"
+            f"📊 {processed}/{row['total']} "
+            f"(✅ {successful}, ❌ {failed})\n"
+            f"⚡ {rate:.1f} сообщ./с, осталось ~{format_duration(eta)}\n"
+        )
         
-        await asyncio.sleep(0.03)  # Минимальная пауза
+        if status == 'cancelling':
+            continue
+        if status == 'paused':
+            toggle = InlineKeyboardButton(f"▶️ #{job_id}", callback_data=f"job_resume_{job_id}")
+        else:
+            toggle = InlineKeyboardButton(f"⏸ #{job_id}", callback_data=f"job_pause_{job_id}")
+        keyboard.append([toggle, InlineKeyboardButton(f"⛔ #{job_id}", callback_data=f"job_cancel_{job_id}")])
     
-    # Очистка заблокировавших
-    if blocked_users:
-        try:
-            users = load_users()
-            for user_id in blocked_users:
-                users.pop(user_id, None)
-            
-            with open(USERS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(users, f, ensure_ascii=False, indent=2)
-            cache.set_users(users)
-        except Exception as e:
-            logger.error(f"Error cleaning blocked users: {e}")
+    keyboard.append([InlineKeyboardButton("🔄 Обновить", callback_data="jobs_list")])
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin")])
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def jobs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Список выполняющихся рассылок"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Нет прав доступа.")
+        return
     
-    final_text = f"✅ **Быстрая рассылка завершена!**\n\n"
-    final_text += f"👥 Всего пользователей: {total_users}\n"
-    final_text += f"✅ Успешно отправлено: {successful}\n"
-    final_text += f"❌ Ошибок: {failed}\n"
-    final_text += f"🚫 Удалено заблокировавших: {len(blocked_users)}"
+    text, reply_markup = await build_jobs_panel()
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def jobs_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопки паузы, продолжения и отмены рассылки"""
+    query = update.callback_query
     
+    if not is_admin(query.from_user.id):
+        await query.answer()
+        return
+    
+    if query.data != "jobs_list":
+        _, action, job_id = query.data.split('_')
+        
+        if not await control_delivery_job(int(job_id), action):
+            await query.answer("Рассылка уже завершена")
+        elif action == "pause":
+            await query.answer("⏸ Рассылка приостановлена")
+        elif action == "resume":
+            await query.answer("▶️ Рассылка продолжена")
+        elif action == "cancel":
+            await query.answer("⛔ Рассылка отменяется")
+    else:
+        await query.answer()
+    
+    text, reply_markup = await build_jobs_panel()
     try:
-        await status_msg.edit_text(final_text)
-    except:
-        pass
+        await query.message.edit_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Текст не изменился с прошлого обновления
+        if "not modified" not in str(e).lower():
+            raise
 
 # ===== КОМАНДЫ СОХРАНЕНИЯ =====
 async def save_channel_now(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1362,7 +2782,7 @@ async def save_channel_now(update: Update, context: ContextTypes.DEFAULT_TYPE):
         has_permissions = await check_bot_permissions(chat_id, context)
         
         if has_permissions:
-            save_broadcast_channel(chat_id, chat_title)
+            await save_broadcast_channel(chat_id, chat_title)
             
             await asyncio.sleep(0.5)
             
@@ -1409,7 +2829,7 @@ async def save_channel_by_id(update: Update, context: ContextTypes.DEFAULT_TYPE)
             chat = await context.bot.get_chat(channel_id)
             chat_title = getattr(chat, 'title', f"Канал {channel_id}")
             
-            save_broadcast_channel(channel_id, chat_title)
+            await save_broadcast_channel(channel_id, chat_title)
             
             await asyncio.sleep(0.5)
             
@@ -1468,7 +2888,7 @@ async def test_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
         channel_id = int(context.args[0])
         chat = await context.bot.get_chat(channel_id)
         
-        me = await context.bot.get_me()
+        me = await get_bot_user(context.bot)
         try:
             bot_member = await context.bot.get_chat_member(channel_id, me.id)
             bot_status = bot_member.status
@@ -1476,7 +2896,7 @@ async def test_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if bot_status in ['administrator', 'creator']:
                 status_text = "✅ Бот имеет доступ к управлению"
                 
-                save_broadcast_channel(channel_id, getattr(chat, 'title', f"Канал {channel_id}"))
+                await save_broadcast_channel(channel_id, getattr(chat, 'title', f"Канал {channel_id}"))
                 status_text += "\n✅ Канал добавлен в рассылку"
             else:
                 status_text = "❌ Бот не имеет прав администратора"
@@ -1522,9 +2942,202 @@ async def stealth_clean(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Ошибка оптимизации")
 
 # ===== ГЛАВНАЯ ФУНКЦИЯ (ПОЛНАЯ) =====
-def main():
-    """Основная функция запуска бота"""
-    application = Application.builder().token(API_TOKEN).build()
+async def on_startup(application: Application):
+    """Профиль бота уже получен при initialize(), запоминаем его.
+    Загружаем статистику пользователей, прерванные рассылки продолжаем."""
+    global _bot_user
+    _bot_user = application.bot.bot
+    logger.info(f"Running as @{_bot_user.username} ({_bot_user.id})")
+    
+    await user_stats.load()
+    await resume_delivery_jobs(application.bot)
+
+async def on_stop(application: Application):
+    """Останавливаем рассылки, пока HTTP-клиент бота еще открыт: начатые
+    запросы должны успеть получить ответ"""
+    await stop_delivery_jobs()
+
+async def on_shutdown(application: Application):
+    """Гарантированно сохраняем буфер пользователей при остановке"""
+    flushed = await user_buffer.flush()
+    logger.info(f"Flushed {flushed} pending users on shutdown")
+    # Следующий запуск сможет сразу получать обновления через polling
+    await storage.run(DB_FILE, _release_lease, POLLING_LEASE, WORKER_ID)
+    storage.shutdown()
+
+async def renew_polling_lease_job(context: ContextTypes.DEFAULT_TYPE):
+    """Продлевает право этого процесса на getUpdates. Если процесс подвис
+    дольше LEASE_TTL и право забрал другой, останавливаемся: вдвоем
+    оба получали бы 409 Conflict."""
+    if not await storage.run(DB_FILE, _acquire_lease, POLLING_LEASE, WORKER_ID, LEASE_TTL):
+        logger.error("Polling lease taken over by another bot process, stopping")
+        context.application.stop_running()
+
+def acquire_polling_lease() -> bool:
+    """Ждет, пока освободится право на polling: после падения прошлого
+    запуска аренда истекает через LEASE_TTL. False - его держит живой процесс."""
+    # С запасом: аренда упавшего процесса истекает не позже чем через LEASE_TTL
+    deadline = time.monotonic() + LEASE_TTL + 5
+    while not _acquire_lease(POLLING_LEASE, WORKER_ID, LEASE_TTL):
+        if time.monotonic() > deadline:
+            return False
+        logger.info("Another bot process is polling, waiting for its lease to expire")
+        time.sleep(1)
+    return True
+
+# ===== ОБРАБОТКА ОБНОВЛЕНИЙ =====
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обновления разных пользователей обрабатываются параллельно,
+    не больше max_concurrent_updates сразу, а одного пользователя - строго
+    по очереди, чтобы не путались состояния диалогов. Обновление, пришедшее
+    во время обработки предыдущего, ставится в очередь пользователя и слот
+    не занимает: очередь разбирает тот, кто уже работает."""
+    def __init__(self, max_concurrent_updates: int, max_queued: int = USER_UPDATE_QUEUE_LIMIT):
+        super().__init__(max_concurrent_updates)
+        self.max_queued = max_queued
+        self._queues: Dict[tuple, deque] = {}
+    
+    @staticmethod
+    def _key(update: object) -> Optional[tuple]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return ('user', update.effective_user.id)
+        if update.effective_chat:
+            return ('chat', update.effective_chat.id)
+        return None
+    
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._key(update)
+        if key is None:
+            await coroutine
+            return
+        
+        queue = self._queues.get(key)
+        if queue is not None:
+            if len(queue) >= self.max_queued:
+                logger.warning(f"Update queue for {key} is full, dropping update")
+                coroutine.close()
+            else:
+                queue.append(coroutine)
+            return
+        
+        queue = self._queues[key] = deque([coroutine])
+        try:
+            while queue:
+                try:
+                    await queue.popleft()
+                except Exception as e:
+                    logger.error(f"Error processing update for {key}: {e}")
+        finally:
+            # При отмене (остановка бота) недоразобранные обновления закрываем
+            for pending in queue:
+                pending.close()
+            del self._queues[key]
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+
+# ===== ВЕБХУК =====
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    """Принимает обновления от Telegram и кладет их в очередь приложения"""
+    def initialize(self, bot_app: Application):
+        self.bot_app = bot_app
+    
+    async def post(self):
+        secret = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            logger.warning(f"Rejected webhook request from {self.request.remote_ip}: bad secret token")
+            raise tornado.web.HTTPError(403)
+        
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot_app.bot)
+        except Exception as e:
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            raise tornado.web.HTTPError(400)
+        
+        await self.bot_app.update_queue.put(update)
+
+class HealthHandler(tornado.web.RequestHandler):
+    """Проверка для балансировщика: 200, когда бот принимает обновления"""
+    def initialize(self, bot_app: Application):
+        self.bot_app = bot_app
+    
+    def get(self):
+        if not self.bot_app.running:
+            self.set_status(503)
+        self.write({
+            'status': 'ok' if self.bot_app.running else 'starting',
+            'pending_updates': self.bot_app.update_queue.qsize(),
+            'active_jobs': len(active_jobs)
+        })
+
+async def run_webhook(application: Application):
+    """Запуск в режиме вебхука. Свой HTTP-сервер вместо run_webhook() из PTB,
+    чтобы рядом с вебхуком был /health."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    server = HTTPServer(tornado.web.Application([
+        (WEBHOOK_PATH, TelegramWebhookHandler, {'bot_app': application}),
+        ('/health', HealthHandler, {'bot_app': application}),
+    ]))
+    
+    # Тот же порядок, что в run_polling(): post_init после initialize,
+    # post_shutdown после shutdown. Рассылки останавливаем до stop():
+    # после выхода из async with HTTP-клиент бота уже закрыт
+    async with application:
+        await application.post_init(application)
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET
+        )
+        await application.start()
+        server.listen(WEBHOOK_PORT, WEBHOOK_LISTEN)
+        logger.info(f"Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        
+        try:
+            await stop.wait()
+        finally:
+            server.stop()
+            await stop_delivery_jobs()
+            await application.stop()
+    await application.post_shutdown(application)
+
+def build_application() -> Application:
+    """Приложение со всеми обработчиками и фоновыми задачами"""
+    builder = (
+        Application.builder()
+        .token(API_TOKEN)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    application = builder.build()
+    
+    application.job_queue.run_repeating(
+        flush_users_job, interval=USER_FLUSH_INTERVAL, first=USER_FLUSH_INTERVAL
+    )
+    application.job_queue.run_repeating(
+        refresh_channel_access_job, interval=ACCESS_REFRESH_INTERVAL, first=10
+    )
+    application.job_queue.run_repeating(
+        resume_delivery_jobs_job, interval=LEASE_TTL, first=LEASE_TTL
+    )
+    application.job_queue.run_repeating(
+        reload_user_stats_job, interval=USER_STATS_RELOAD_INTERVAL, first=USER_STATS_RELOAD_INTERVAL
+    )
+    application.job_queue.run_repeating(
+        log_cache_stats_job, interval=CACHE_STATS_LOG_INTERVAL, first=CACHE_STATS_LOG_INTERVAL
+    )
     
     # Команды
     application.add_handler(CommandHandler("start", start))
@@ -1539,6 +3152,7 @@ def main():
     
     application.add_handler(CommandHandler("testaccess", test_access))
     application.add_handler(CommandHandler("clean", stealth_clean))
+    application.add_handler(CommandHandler("jobs", jobs_command))
     
     # ConversationHandler для добавления каналов
     conv_handler = ConversationHandler(
@@ -1556,12 +3170,11 @@ def main():
         entry_points=[CallbackQueryHandler(broadcast_start, pattern='^broadcast_start$')],
         states={
             BROADCAST_WAITING: [
-                MessageHandler(
-                    filters.TEXT | filters.PHOTO | filters.VIDEO | filters.Document.ALL,
-                    handle_broadcast_content
-                )
+                MessageHandler(BROADCAST_CONTENT_FILTER, handle_broadcast_content)
             ],
             BROADCAST_CONFIRM: [
+                # Остальные части альбома приходят уже после подтверждения первой
+                MessageHandler(BROADCAST_CONTENT_FILTER, handle_broadcast_content),
                 CallbackQueryHandler(execute_broadcast, pattern='^broadcast_(confirm|cancel)$')
             ]
         },
@@ -1571,15 +3184,14 @@ def main():
     
     # ConversationHandler для рассылки пользователям
     notify_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(notify_users_callback, pattern='^notify_users_start$')],
+        entry_points=[CallbackQueryHandler(notify_users_callback, pattern=r'^notify_segment_\w+$')],
         states={
             NOTIFY_WAITING: [
-                MessageHandler(
-                    filters.TEXT | filters.PHOTO | filters.VIDEO | filters.Document.ALL,
-                    handle_notify_content
-                )
+                MessageHandler(BROADCAST_CONTENT_FILTER, handle_notify_content)
             ],
             NOTIFY_CONFIRM: [
+                # Остальные части альбома приходят уже после подтверждения первой
+                MessageHandler(BROADCAST_CONTENT_FILTER, handle_notify_content),
                 CallbackQueryHandler(execute_notify_users, pattern='^notify_(confirm|cancel)$')
             ]
         },
@@ -1609,8 +3221,27 @@ def main():
     application.add_handler(CallbackQueryHandler(notify_users_callback, pattern='^notify_panel$'))
     
     application.add_handler(CallbackQueryHandler(back_to_admin_callback, pattern='^back_to_admin$'))
+    application.add_handler(CallbackQueryHandler(jobs_callback, pattern=r'^(jobs_list|job_(pause|resume|cancel)_\d+)$'))
+    return application
+
+def main():
+    """Основная функция запуска бота"""
+    # Открываем базу заранее: при первом запуске переносим users.json
+    get_db()
+    application = build_application()
     
     print("🤖 Бот запущен со всеми функциями...")
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+        return
+    
+    if not acquire_polling_lease():
+        print("❌ ОШИБКА: обновления уже получает другой процесс бота (polling)!")
+        print("Для нескольких процессов используйте вебхук (WEBHOOK_URL, WEBHOOK_SECRET), см. README")
+        exit(1)
+    application.job_queue.run_repeating(
+        renew_polling_lease_job, interval=LEASE_TTL / 3, first=LEASE_TTL / 3
+    )
     application.run_polling()
 
 if __name__ == '__main__':
@@ -0,0 +1,111 @@
+"""Общее для тестов: бот в режиме вебхука против поддельного Bot API"""
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+
+import pytest
+import tornado.web
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+API_PORT = _free_port()
+WEBHOOK_PORT = _free_port()
+TOKEN = '123456:TEST'
+SECRET = 'test-secret_1'
+WEBHOOK_BASE = f'http://127.0.0.1:{WEBHOOK_PORT}'
+
+# Настройки читаются при импорте бота
+os.environ.update({
+    'BOT_TOKEN': TOKEN,
+    'WEBHOOK_URL': 'https://bot.example.com/',
+    'WEBHOOK_PATH': '/telegram',
+    'WEBHOOK_LISTEN': '127.0.0.1',
+    'WEBHOOK_PORT': str(WEBHOOK_PORT),
+    'WEBHOOK_SECRET': SECRET,
+    'TELEGRAM_API_URL': f'http://127.0.0.1:{API_PORT}/bot',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sex  # noqa: E402
+
+
+class FakeBotApi(tornado.web.RequestHandler):
+    """Отвечает на методы Bot API и запоминает вызовы.
+    sendMessage отвечает с задержкой send_delay, как медленный Telegram."""
+    def initialize(self, calls: list, send_delay: float):
+        self.calls = calls
+        self.send_delay = send_delay
+
+    async def post(self, token: str, method: str):
+        assert token == TOKEN
+        if self.request.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(self.request.body or b'{}')
+        else:
+            params = {key: values[-1].decode() for key, values in self.request.body_arguments.items()}
+        self.calls.append((method, params))
+
+        if method == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Test', 'username': 'test_bot'}
+        elif method == 'sendMessage':
+            await asyncio.sleep(self.send_delay)
+            result = {
+                'message_id': len(self.calls), 'date': int(time.time()),
+                'chat': {'id': int(params['chat_id']), 'type': 'private'}, 'text': params.get('text', '')
+            }
+        else:
+            result = True
+        self.write({'ok': True, 'result': result})
+
+
+def start_fake_api(calls: list, send_delay: float = 0) -> HTTPServer:
+    """Запускается внутри цикла событий теста"""
+    server = HTTPServer(tornado.web.Application([
+        (r'/bot(?P<token>[^/]+)/(?P<method>\w+)', FakeBotApi, {'calls': calls, 'send_delay': send_delay}),
+    ]))
+    server.listen(API_PORT, '127.0.0.1')
+    return server
+
+
+async def wait_for(predicate, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not await predicate():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.05)
+
+
+async def webhook_healthy() -> bool:
+    try:
+        response = await AsyncHTTPClient().fetch(f'{WEBHOOK_BASE}/health', raise_error=False)
+    except OSError:
+        # Сервер вебхука еще не слушает порт
+        return False
+    return response.code == 200
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    """Модуль бота с чистым состоянием в отдельном каталоге: каждый тест
+    запускает свой цикл событий, а on_shutdown закрывает хранилище"""
+    monkeypatch.chdir(tmp_path)
+    sex._db = None
+    sex._bot_user = None
+    sex._deliveries_stopping = False
+    sex.active_jobs.clear()
+    sex.delivery_tasks.clear()
+    sex.storage = sex.AsyncStorage()
+    sex.cache = sex.Cache()
+    sex.send_limiter.__init__()
+    yield sex
+    if sex._db is not None:
+        sex._db.close()
+        sex._db = None
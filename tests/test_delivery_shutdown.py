@@ -0,0 +1,48 @@
+"""Остановка бота посреди рассылки: никто не должен получить сообщение дважды"""
+import asyncio
+import os
+import signal
+import sqlite3
+from types import SimpleNamespace
+
+from conftest import start_fake_api, wait_for, webhook_healthy
+
+
+async def _interrupt_delivery(sex, recipients: int) -> list:
+    calls = []
+    # Медленный Telegram: в момент остановки часть запросов еще в полете
+    api_server = start_fake_api(calls, send_delay=0.3)
+    application = sex.build_application()
+    runner = asyncio.create_task(sex.run_webhook(application))
+    try:
+        await wait_for(webhook_healthy)
+        progress_msg = SimpleNamespace(chat_id=1, message_id=1)
+        await sex.start_delivery_job(
+            application.bot, 'quick', {'content': 'hi'}, list(range(1000, 1000 + recipients)), progress_msg
+        )
+
+        async def in_flight():
+            return sum(method == 'sendMessage' for method, _ in calls) >= 30
+        await wait_for(in_flight)
+    finally:
+        if not runner.done():
+            os.kill(os.getpid(), signal.SIGTERM)
+        await asyncio.wait_for(runner, 30)
+        api_server.stop()
+    return [int(params['chat_id']) for method, params in calls if method == 'sendMessage']
+
+
+def test_shutdown_does_not_requeue_attempted_recipients(bot):
+    reached = asyncio.run(_interrupt_delivery(bot, 2000))
+
+    db = sqlite3.connect(bot.DB_FILE)
+    statuses = dict(db.execute("SELECT chat_id, status FROM delivery_recipients").fetchall())
+    db.close()
+
+    # Рассылка прервана, а не доведена до конца
+    assert any(status == bot.RECIPIENT_PENDING for status in statuses.values())
+    # Взятые без отправки вернулись в очередь
+    assert bot.RECIPIENT_CLAIMED not in statuses.values()
+    # До Telegram дошли - значит при следующем запуске повторять нельзя
+    requeued = [chat_id for chat_id in reached if statuses[chat_id] == bot.RECIPIENT_PENDING]
+    assert requeued == []
@@ -0,0 +1,64 @@
+"""Режим вебхука против локального поддельного Bot API (TELEGRAM_API_URL)"""
+import asyncio
+import json
+import os
+import signal
+import time
+
+from tornado.httpclient import AsyncHTTPClient
+
+from conftest import SECRET, WEBHOOK_BASE, start_fake_api, wait_for, webhook_healthy
+
+
+def _start_update(user_id: int) -> dict:
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'Ivan', 'username': 'ivan'}
+    return {
+        'update_id': 1,
+        'message': {
+            'message_id': 10, 'date': int(time.time()), 'from': user,
+            'chat': {'id': user_id, 'type': 'private', 'first_name': 'Ivan'},
+            'text': '/start', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+        }
+    }
+
+
+async def _scenario(sex) -> list:
+    calls = []
+    api_server = start_fake_api(calls)
+    client = AsyncHTTPClient()
+
+    async def post(body: bytes, secret=None):
+        headers = {'Content-Type': 'application/json'}
+        if secret is not None:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+        return await client.fetch(f'{WEBHOOK_BASE}/telegram', method='POST', body=body,
+                                  headers=headers, raise_error=False)
+
+    runner = asyncio.create_task(sex.run_webhook(sex.build_application()))
+    try:
+        await wait_for(webhook_healthy)
+
+        webhooks = [params for method, params in calls if method == 'setWebhook']
+        assert webhooks == [{'url': 'https://bot.example.com/telegram', 'secret_token': SECRET}]
+
+        update = json.dumps(_start_update(777)).encode()
+        assert (await post(update)).code == 403
+        assert (await post(update, 'wrong')).code == 403
+        assert (await post(b'{not json', SECRET)).code == 400
+        assert (await post(update, SECRET)).code == 200
+
+        async def answered():
+            return any(method == 'sendMessage' and int(params['chat_id']) == 777 for method, params in calls)
+        await wait_for(answered)
+    finally:
+        # run_webhook останавливается по SIGTERM, как на хостинге
+        if not runner.done():
+            os.kill(os.getpid(), signal.SIGTERM)
+        await asyncio.wait_for(runner, 20)
+        api_server.stop()
+    return calls
+
+
+def test_webhook_against_fake_bot_api(bot):
+    calls = asyncio.run(_scenario(bot))
+    assert calls[0][0] == 'getMe'